@@ -6,11 +6,17 @@ import signal
 import atexit
 import re
 import logging
+import tempfile
+from functools import partial
 from tqdm import tqdm
 import yaml
 from pathlib import Path
 import click
-from visualize import Visualizer
+from visualize import Visualizer, STATIC_ENGINES, STATIC_FORMATS
+from watch import RefreshScheduler
+from query import ExportIndex, parse_tag_filter
+from checkpoint import ExportCheckpoint, DEFAULT_CHECKPOINT_DIR
+from config_backend import AwsConfigBackend
 from pprint import pprint
 
 __author__ = "Anton Coleman"
@@ -140,12 +146,94 @@ def replace_unique_chars(param_string, replacement_patterns):
         return None
 
 
+def fetch_unfiltered(func, cache=None, cache_key=None):
+    """
+    Call a describe method without filters, reusing the response already fetched during this run.
+
+    Args:
+        func: boto3 describe method
+        cache: Dict holding responses fetched during this run, None disables caching
+        cache_key: Key identifying the operation (profile, region, client type, method)
+
+    Returns:
+
+    """
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+    val = func()
+    val.pop('ResponseMetadata', None)
+    if cache is not None:
+        cache[cache_key] = val
+    return val
+
+
+def build_filter_index(response, attributes):
+    """
+    Index the items of an unfiltered describe response by every requested filter attribute.
+
+    Args:
+        response: Describe response with ResponseMetadata removed
+        attributes: Filter attribute names to index
+
+    Returns:
+        Dict of {response key: {attribute: {value: [item positions]}}}
+
+    """
+    index = {}
+    for rk, items in response.items():
+        if not isinstance(items, list):
+            continue
+        attr_index = {attr: {} for attr in attributes}
+        for pos, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            for attr, values in attr_index.items():
+                if attr in item:
+                    try:
+                        values.setdefault(item[attr], []).append(pos)
+                    except TypeError:
+                        # Unhashable attribute values can not be used as filters
+                        continue
+        index[rk] = attr_index
+    return index
+
+
+def lookup_filter_index(items, attr_index, filters):
+    """
+    Serve the items matching any of the filter values from an index built by build_filter_index.
+
+    Args:
+        items: Items of a single response key
+        attr_index: Index for the response key
+        filters: Dict of {attribute: [values]}
+
+    Returns:
+        Matching items in response order
+
+    """
+    positions = set()
+    for attr, wanted in filters.items():
+        values = attr_index.get(attr)
+        if not values:
+            continue
+        for value in (wanted if type(wanted) == list else [wanted]):
+            try:
+                positions.update(values.get(value, ()))
+            except TypeError:
+                continue
+    return [items[pos] for pos in sorted(positions)]
+
+
 # iterate over the methods of the class
 def export_aws_config(schema, keywords, excludes, aws_profile=None, patterns=None, method_match='describe',
-                      resource_type='ec2', region='us-east-2', **kwargs):
+                      resource_type='ec2', region='us-east-2', cache=None, skip_methods=(), on_method_complete=None,
+                      **kwargs):
     """
 
     Args:
+        cache: Dict shared across calls so unfiltered describe responses are only fetched once per run
+        skip_methods: Describe method names that are already exported and must not be called
+        on_method_complete: Callable receiving (method name, method export) after each method completes
         method_match: Type of method to match against [only describe is currently supported]
         patterns: Dict - Replacement values for unique chars within request params
         resource_type: Type of resource to describe examples are ['ec2','s3','iam','sns']
@@ -177,6 +265,10 @@ def export_aws_config(schema, keywords, excludes, aws_profile=None, patterns=Non
                         if keyword in name:
                             # Check if the method is to be excluded from exporting
                             if not any(i in name for i in excludes):
+                                if name in skip_methods:
+                                    # Already exported, e.g. restored from a checkpoint
+                                    break
+                                method_schema = {}
                                 method_obj = getattr(client, method)
                                 # Extract Docstrings to retrieve filtering options
                                 doc = method_obj.__doc__
@@ -184,8 +276,16 @@ def export_aws_config(schema, keywords, excludes, aws_profile=None, patterns=Non
                                 config_type = (name.split("describe_"))[1]
                                 # Check if filter options exist
                                 if bool(kwargs):
-                                    for k, v in kwargs.items():
-                                        if ops is not None:
+                                    if ops is None:
+                                        # No server side filters, fetch once and serve every filter key from an index
+                                        val = fetch_unfiltered(method_obj, cache,
+                                                               (aws_profile, region, resource_type, name))
+                                        index = build_filter_index(val, kwargs.keys())
+                                        for i in val:
+                                            matches = lookup_filter_index(val[i], index.get(i, {}), kwargs)
+                                            method_schema.update({i: matches if matches else {}})
+                                    else:
+                                        for k, v in kwargs.items():
                                             if type(v) == list:
                                                 item_range = len(v)
                                                 for n in range(item_range):
@@ -193,7 +293,8 @@ def export_aws_config(schema, keywords, excludes, aws_profile=None, patterns=Non
                                                                              f'{v[n]}',
                                                                      bar_format='{l_bar}{bar:15}{r_bar}{bar:-15b}'):
                                                         # Unique for vpc ids following attachments
-                                                        # TODO build function to set replacement values for normalization
+                                                        # TODO build function to set replacement values for
+                                                        #  normalization
                                                         k = k.replace('attachment_', 'attachment.')
                                                         k = k.replace('_', '-')
                                                         filtered = filter_data(k, options=ops,
@@ -202,32 +303,23 @@ def export_aws_config(schema, keywords, excludes, aws_profile=None, patterns=Non
                                                             # Remove unnecessary data
                                                             filtered.pop('ResponseMetadata')
                                                             for fk in filtered:
-                                                                if fk in schema:
+                                                                if fk in method_schema:
                                                                     filtered_length = len(filtered[fk])
                                                                     if filtered_length >= 1:
                                                                         for i in range(filtered_length):
-                                                                            if filtered[fk][i] not in schema[fk]:
-                                                                                schema[fk].append(filtered[fk][i])
+                                                                            fi = filtered[fk][i]
+                                                                            if fi not in method_schema[fk]:
+                                                                                method_schema[fk].append(fi)
                                                                 else:
-                                                                    schema.update({fk: filtered[fk]})
-                                        else:
-                                            val = method_obj()
-                                            val.pop('ResponseMetadata')
-                                            item_list = []
-                                            for i in val:
-                                                schema.update({i: {}})
-                                                for o in val[i]:
-                                                    if k in o:
-                                                        for vi in v:
-                                                            if vi == o[k]:
-                                                                item_list.append(o)
-                                                                schema[i] = item_list
-                                    else:
-                                        break
+                                                                    method_schema.update({fk: filtered[fk]})
                                 else:
-                                    val = method_obj()
-                                    val.pop('ResponseMetadata')
-                                    schema.update(val)
+                                    val = fetch_unfiltered(method_obj, cache,
+                                                           (aws_profile, region, resource_type, name))
+                                    method_schema.update(val)
+                                schema.update(method_schema)
+                                if on_method_complete is not None:
+                                    on_method_complete(name, method_schema)
+                                break
         return schema
     except Exception as e:
         return f'Failed to generate AWS configuration export with error: {e}'
@@ -280,15 +372,23 @@ def rebuild_aws_network_config(schema):  # TODO Future Implementation if transfo
 
 def generate_json_file(filename, config):
     """
+        Writes the JSON file through a temporary file and an atomic swap, readers never see a partial export.
+
         Args:
             config: AWS Configuration Dictionary
             filename: the actual filename to generate for json
     """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix=f'.{os.path.basename(filename)}.', dir=directory)
     try:
-        with open(filename, 'w') as f:
+        with os.fdopen(fd, 'w') as f:
             # Convert dictionary to JSON
             json.dump(config, f, indent=4, default=str, sort_keys=True)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
     except Exception as e:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
         raise e
 
 
@@ -300,20 +400,16 @@ def load_definition(filename):
         sys.exit(1)
 
 
-@click.command()
-@click.option('--f', default='definitions.yaml', help='YAML filename that includes AWS Definitions')
-def orchestrate_aws_export(f):
+def new_export_schema(config):
     """
-    Orchestrates the AWS Configuration Export by loading the definition file and generating the configuration export,
-    then generating the JSON file for the configuration export.
+    Build the top level export schema for a definition
 
     Args:
-        f: filename for the definition file
+        config: Loaded definition file
 
     Returns:
 
     """
-    config = load_definition(f)
     schema = {
         "product_type": "software_ngfw",
         "cloud_provider": "aws",
@@ -325,7 +421,112 @@ def orchestrate_aws_export(f):
             schema['customer'] = config['customer']
         else:
             schema['customer'] = 'Default Customer'
+    return schema
+
+
+def export_filename(config):
+    """
+    Output filename for the JSON export of a definition
+
+    Args:
+        config: Loaded definition file
+
+    Returns:
+
+    """
+    if len(config["regions"]) > 1:
+        return f'multi-region-aws-config.json'
+    return f'{list(config["regions"][0].keys())[0]}-aws-config.json'
+
+
+def resolve_client_options(config, attrs, rtype):
+    """
+    Resolve the include keywords, exclusions and filters for a boto3 client type
+
+    Args:
+        config: Loaded definition file
+        attrs: Environment attributes from the definition file
+        rtype: boto3 client type, ec2 or elbv2
+
+    Returns:
+        Tuple of (includes, excludes, filters)
+
+    """
+    if rtype == 'ec2':
+        # TODO Add Defaults if data is missing from defintion
+        includes = config["ec2_includes"]
+        excludes = config["ec2_exclusions"]
+        filters = {
+            'vpc_id': attrs['vpc_ids'],
+            'transit_gateway_id': attrs['tgw_ids'],
+            'service_name': attrs['service_names'],
+            'attachment_vpc_id': attrs['vpc_ids'],
+        }
+    elif rtype == 'elbv2':
+        # TODO Add Defaults if data is missing from defintion
+        includes = config["elb_includes"]
+        filters = {
+            'VpcId': attrs['vpc_ids']
+        }
+        excludes = []
+    else:
+        raise ValueError(f'Unsupported aws resource type: {rtype}')
+    return includes, excludes, filters
+
+
+def export_resource_type(config, region, attrs, rtype, keywords=None, cache=None, **kwargs):
+    """
+    Export a single (region, environment, resource type) unit of a definition
+
+    Args:
+        config: Loaded definition file
+        region: AWS Region
+        attrs: Environment attributes from the definition file
+        rtype: boto3 client type, ec2 or elbv2
+        keywords: Include keywords to export, defaults to every include for the client type
+        cache: Dict shared across calls so unfiltered describe responses are only fetched once
+        **kwargs: skip_methods and on_method_complete, passed through to export_aws_config
+
+    Returns:
+
+    """
+    includes, excludes, filters = resolve_client_options(config, attrs, rtype)
+    result = export_aws_config(aws_profile=config["aws_profile"],
+                               schema={},
+                               keywords=keywords if keywords is not None else includes,
+                               excludes=excludes,
+                               region=region,
+                               resource_type=rtype,
+                               cache=cache,
+                               **kwargs,
+                               **filters
+                               )
+    if isinstance(result, str):
+        raise RuntimeError(result)
+    return result
+
+
+def describe_aws_export(config, schema, definition, resume=False, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+    """
+    Populate the export schema with the per method describe backend. Every completed (region, environment, resource
+    type, operation) unit is persisted to the checkpoint directory and the export is assembled from it, so a failed
+    run can be resumed without repeating the completed units.
+
+    Args:
+        config: Loaded definition file
+        schema: Export schema from new_export_schema
+        definition: Text of the definition file
+        resume: Skip the units completed by a previous run
+        checkpoint_dir: Directory holding the completed units
+
+    Returns:
+
+    """
+    checkpoint = ExportCheckpoint(checkpoint_dir)
+    checkpoint.start(definition, schema, resume=resume)
 
+    # Unfiltered describe responses shared by every environment in this run
+    fetch_cache = {}
     for region in config["regions"]:
         for rk in region:
             logger.info(f'Accessing region: {rk}')
@@ -339,56 +540,202 @@ def orchestrate_aws_export(f):
                 if 'resource_types' in attrs:
                     for rtype in attrs['resource_types']:
                         logger.info(f'Accessing AWS Client Type: {rtype}')
-                        if rtype == 'ec2':
-                            # TODO Add Defaults if data is missing from defintion
-                            includes = config["ec2_includes"]
-                            excludes = config["ec2_exclusions"]
-                            filters = {
-                                'vpc_id': attrs['vpc_ids'],
-                                'transit_gateway_id': attrs['tgw_ids'],
-                                'service_name': attrs['service_names'],
-                                'attachment_vpc_id': attrs['vpc_ids'],
-                            }
-                        if rtype == 'elbv2':
-                            # TODO Add Defaults if data is missing from defintion
-                            includes = config["elb_includes"]
-                            filters = {
-                                'VpcId': attrs['vpc_ids']
-                            }
-                            excludes = []
+                        completed = checkpoint.completed(rk, env, rtype)
+                        if completed:
+                            logger.info(f'Skipping {len(completed)} operations completed by a previous run')
                         try:
-                            result = export_aws_config(aws_profile=config["aws_profile"],
-                                                       schema={},
-                                                       keywords=includes,
-                                                       excludes=excludes,
-                                                       region=rk,
-                                                       resource_type=rtype,
-                                                       **filters
-                                                       )
-
-                            schema['regions'][rk][env].update(result)
+                            export_resource_type(config, rk, attrs, rtype, cache=fetch_cache, skip_methods=completed,
+                                                 on_method_complete=partial(checkpoint.save, rk, env, rtype))
                             logger.info(
                                 f'Completed configuration retrieval for environment **{env}** using the **{rtype}** '
                                 f'client')
                         except Exception as e:
                             print(e)
+                            logger.error(f'Completed operations are saved in {checkpoint_dir}, rerun with --resume '
+                                         f'to retry only the failed operations')
                             sys.exit(1)
+                        checkpoint.assemble(schema['regions'][rk][env], rk, env, rtype)
 
                 else:
                     raise f'No aws resource type was specified in the definition'
+    return schema
 
-    if len(config["regions"]) > 1:
-        filename = f'multi-region-aws-config.json'
-        generate_json_file(filename, schema)
-        logger.info(f'Generated {filename}')
+
+def orchestrate_aws_export(f, resume=False, checkpoint_dir=DEFAULT_CHECKPOINT_DIR):
+    """
+    Orchestrates the AWS Configuration Export by loading the definition file and generating the configuration export,
+    then generating the JSON file for the configuration export. The ``backend`` of the definition file selects
+    per method describes (default, checkpointed and resumable) or a single AWS Config aggregator query.
+
+    Args:
+        f: filename for the definition file
+        resume: Skip the units completed by a previous run, describe backend only
+        checkpoint_dir: Directory holding the completed units, describe backend only
+
+    Returns:
+
+    """
+    config = load_definition(f)
+    schema = new_export_schema(config)
+    backend = config.get('backend') or 'describe'
+    logger.info(f'Exporting with the {backend} backend')
+    if backend == 'describe':
+        describe_aws_export(config, schema, Path(f).read_text(), resume=resume, checkpoint_dir=checkpoint_dir)
+    elif backend == 'aws_config':
+        try:
+            AwsConfigBackend.from_definition(config).export(config, schema)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
     else:
-        filename = f'{list(config["regions"][0].keys())[0]}-aws-config.json'
-        generate_json_file(filename, schema)
-        logger.info(f'Generated {filename}')
+        raise ValueError(f'Unsupported export backend: {backend}')
+
+    filename = export_filename(config)
+    generate_json_file(filename, schema)
+    if backend == 'describe':
+        ExportCheckpoint(checkpoint_dir).complete()
+    logger.info(f'Generated {filename}')
     logger.info(f'Completed AWS Configuration Extraction')
     init_visualization(schema)
 
 
+def watch_aws_export(f):
+    """
+    Keep the AWS Configuration Export continuously updated. Every (region, environment, resource type, include
+    keyword) is refreshed on its own interval from the ``watch`` block of the definition file, refreshes are
+    staggered to smooth the API load and the JSON / visual outputs are swapped in atomically, at most once per
+    ``publish_interval`` so rewriting a large export never paces the refreshes.
+
+    Args:
+        f: filename for the definition file
+
+    Returns:
+
+    """
+    config = load_definition(f)
+    watch_config = config.get('watch') or {}
+    default_interval = watch_config.get('default_interval', 900)
+    intervals = watch_config.get('intervals') or {}
+    visualize = watch_config.get('visualize', True)
+    schema = new_export_schema(config)
+    filename = export_filename(config)
+    scheduler = RefreshScheduler(stagger=watch_config.get('stagger', 5),
+                                 publish_interval=watch_config.get('publish_interval', 60))
+
+    for region in config["regions"]:
+        for rk in region:
+            schema['regions'].update({rk: {}})
+            environments = region[rk]
+            for env in environments:
+                attrs = environments[env]
+                schema['regions'][rk].update({env: {}})
+                if 'resource_types' not in attrs:
+                    raise ValueError(f'No aws resource type was specified for environment {env} in {rk}')
+                for rtype in attrs['resource_types']:
+                    includes, excludes, filters = resolve_client_options(config, attrs, rtype)
+                    for keyword in includes:
+                        scheduler.add((rk, env, rtype, keyword), intervals.get(keyword, default_interval))
+
+    def refresh(unit):
+        rk, env, rtype, keyword = unit
+        environments = next(region[rk] for region in config["regions"] if rk in region)
+        # A fresh cache per refresh, unfiltered responses must not be served stale across intervals
+        result = export_resource_type(config, rk, environments[env], rtype, keywords=[keyword], cache={})
+        schema['regions'][rk][env].update(result)
+        logger.info(f'Refreshed **{keyword}** for environment **{env}** in {rk} using the **{rtype}** client')
+
+    def publish(units):
+        generate_json_file(filename, schema)
+        if visualize:
+            init_visualization(schema)
+
+    # Seed every environment with a full export so the first publishes never see partial environments
+    seed_cache = {}
+    for region in config["regions"]:
+        for rk in region:
+            for env, attrs in region[rk].items():
+                for rtype in attrs['resource_types']:
+                    try:
+                        schema['regions'][rk][env].update(export_resource_type(config, rk, attrs, rtype,
+                                                                               cache=seed_cache))
+                    except Exception as e:
+                        logger.error(f'Initial export of **{rtype}** for environment **{env}** in {rk} failed, '
+                                     f'it is retried on its refresh interval: {e}')
+    try:
+        publish([])
+    except Exception as e:
+        logger.error(f'Failed to publish the initial export: {e}')
+
+    logger.info(f'Watching {len(scheduler)} export units, writing {filename}')
+    scheduler.run(refresh, publish, seeded=True)
+
+
+@click.group(invoke_without_command=True)
+@click.option('--f', default='definitions.yaml', help='YAML filename that includes AWS Definitions')
+@click.option('--resume', is_flag=True, default=False, help='Resume a failed export, skipping completed operations')
+@click.option('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR, help='Directory holding completed export operations')
+@click.pass_context
+def cli(ctx, f, resume, checkpoint_dir):
+    """
+    Export AWS configuration to JSON, runs a single export when no command is given.
+    """
+    ctx.ensure_object(dict)
+    ctx.obj['definitions'] = f
+    if ctx.invoked_subcommand is None:
+        orchestrate_aws_export(f, resume=resume, checkpoint_dir=checkpoint_dir)
+
+
+@cli.command()
+@click.pass_context
+def watch(ctx):
+    """
+    Continuously refresh the export on the intervals defined in the watch block of the definition file.
+    """
+    watch_aws_export(ctx.obj['definitions'])
+
+
+@cli.command()
+@click.argument('export_file')
+@click.option('--type', 'resource_type', default=None, help='Resource type, e.g. NetworkInterfaces, Instances, Vpcs')
+@click.option('--tag', 'tags', multiple=True, help='Tag filter as key=value or key, can be repeated')
+@click.option('--cidr', default=None, help='Only resources with an address or CIDR inside this network')
+@click.option('--id', 'resource_id', default=None, help='Resource ID or ARN')
+@click.option('--region', default=None, help='AWS Region')
+@click.option('--env', default=None, help='Environment name')
+def query(export_file, resource_type, tags, cidr, resource_id, region, env):
+    """
+    Query an export file by resource type, ID, tags and CIDR, e.g. all ENIs in 10.20.0.0/16 tagged env=prod.
+    """
+    index = ExportIndex.from_file(export_file)
+    results = index.query(resource_type=resource_type, tags=dict(parse_tag_filter(t) for t in tags), cidr=cidr,
+                          resource_id=resource_id, region=region, env=env)
+    click.echo(json.dumps(results, indent=4, default=str, sort_keys=True))
+
+
+@cli.command()
+@click.argument('export_path')
+@click.option('--html', 'html_file', default='aws_network_diagram.html', help='Output html diagram filename')
+@click.option('--static', 'static_file', default=None,
+              help='Render a static diagram to this filename (without extension) instead of the html diagram')
+@click.option('--engine', type=click.Choice(STATIC_ENGINES), default='sfdp',
+              help='Static diagram layout engine, only fdp and dot draw the region and VPC boxes')
+@click.option('--format', 'fmt', type=click.Choice(STATIC_FORMATS), default='svg', help='Static diagram format')
+def visualize(export_path, html_file, static_file, engine, fmt):
+    """
+    Render the html diagram, or a headless static diagram, from an export file or checkpoint directory without
+    loading it in memory.
+    """
+    network = Visualizer()
+    network.set_base_ico_url('https://raw.githubusercontent.com/ancoleman/graph-icons/main/')
+    network.set_html_file(html_file)
+    network.load_export(export_path)
+    network.map_network_config()
+    if static_file:
+        logger.info(f'Generated {network.render_static(static_file, engine=engine, fmt=fmt)}')
+    else:
+        network.render_web_visual()
+
+
 def init_visualization(schema):
     logger.info(f'Initializing AWS Visualization')
     network = Visualizer()
@@ -405,7 +752,7 @@ def cleanup():
 
 if __name__ == '__main__':
     try:
-        orchestrate_aws_export()
+        cli()
         atexit.register(cleanup)
     except Exception as e:
         print(e)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import tempfile
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_DIR = '.aws-config-checkpoint'
+
+
+class ExportCheckpoint:
+    """
+    Persist every completed (region, environment, resource type, operation) unit of an export, laid out as
+    <directory>/<region>/<environment>/<resource type>/<operation>.json, so a failed run can resume
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory=DEFAULT_CHECKPOINT_DIR):
+        self._directory = directory
+
+    def get_directory(self):
+        return self._directory
+
+    def start(self, definition, header, resume=False):
+        """
+        Prepare the checkpoint for a run
+        Args:
+            definition: Text of the definition file, resuming with a different definition is refused
+            header: Top level export fields (product_type, cloud_provider, customer)
+            resume: Keep the completed units of the previous run
+
+        Returns:
+
+        """
+        digest = hashlib.sha256(definition.encode()).hexdigest()
+        manifest = self.get_manifest()
+        if manifest is None and os.path.isdir(self._directory) and os.listdir(self._directory):
+            # Only directories created by a checkpoint are ever cleared, never unrelated user data
+            raise ValueError(f'{self._directory} is not empty and holds no checkpoint, choose another --checkpoint-dir')
+        if resume and manifest is not None and manifest.get('complete'):
+            # Nothing left to resume, reusing the units would write the previous export again
+            logger.info(f'Checkpoint in {self._directory} belongs to a completed export, starting a fresh export')
+            resume = False
+        if resume and manifest is not None:
+            if manifest.get('definitions') != digest:
+                raise ValueError(f'Checkpoint in {self._directory} was created from a different definition file, '
+                                 f'rerun without --resume')
+            logger.info(f'Resuming export from checkpoint {self._directory}')
+        else:
+            self.clear()
+        os.makedirs(self._directory, exist_ok=True)
+        header = {k: v for k, v in header.items() if k != 'regions'}
+        self._write(os.path.join(self._directory, self.MANIFEST), {'definitions': digest, 'header': header})
+
+    def get_manifest(self):
+        """
+        Manifest of the checkpoint, None when there is no checkpoint
+
+        Returns:
+
+        """
+        path = os.path.join(self._directory, self.MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def complete(self):
+        """
+        Mark the export as completed once its output was written, a later resume then starts a fresh export
+
+        Returns:
+
+        """
+        manifest = self.get_manifest()
+        if manifest is None:
+            raise ValueError(f'No checkpoint to complete in {self._directory}')
+        manifest['complete'] = True
+        self._write(os.path.join(self._directory, self.MANIFEST), manifest)
+
+    def _unit_dir(self, region, env, rtype):
+        return os.path.join(self._directory, region, env, rtype)
+
+    def completed(self, region, env, rtype):
+        """
+        Operations already exported for a (region, environment, resource type)
+        Args:
+            region: AWS Region
+            env: Environment name
+            rtype: boto3 client type
+
+        Returns:
+            Set of describe method names
+
+        """
+        unit_dir = self._unit_dir(region, env, rtype)
+        if not os.path.isdir(unit_dir):
+            return set()
+        return {name[:-len('.json')] for name in os.listdir(unit_dir) if name.endswith('.json')}
+
+    def save(self, region, env, rtype, operation, data):
+        """
+        Persist a completed operation
+        Args:
+            region: AWS Region
+            env: Environment name
+            rtype: boto3 client type
+            operation: Describe method name
+            data: Export of the operation
+
+        Returns:
+
+        """
+        unit_dir = self._unit_dir(region, env, rtype)
+        os.makedirs(unit_dir, exist_ok=True)
+        self._write(os.path.join(unit_dir, f'{operation}.json'), data)
+
+    def load(self, region, env, rtype, operation):
+        with open(os.path.join(self._unit_dir(region, env, rtype), f'{operation}.json')) as f:
+            return json.load(f)
+
+    def iter_units(self):
+        """
+        Iterate the completed units in a stable order
+
+        Returns:
+            Generator of (region, env, rtype, operation)
+
+        """
+        if not os.path.isdir(self._directory):
+            return
+        for region in sorted(os.listdir(self._directory)):
+            region_dir = os.path.join(self._directory, region)
+            if not os.path.isdir(region_dir):
+                continue
+            for env in sorted(os.listdir(region_dir)):
+                env_dir = os.path.join(region_dir, env)
+                if not os.path.isdir(env_dir):
+                    continue
+                for rtype in sorted(os.listdir(env_dir)):
+                    for operation in sorted(self.completed(region, env, rtype)):
+                        yield region, env, rtype, operation
+
+    def assemble(self, env_schema, region, env, rtype):
+        """
+        Merge the completed operations of a (region, environment, resource type) into the environment export
+        Args:
+            env_schema: Environment dictionary of the export schema
+            region: AWS Region
+            env: Environment name
+            rtype: boto3 client type
+
+        Returns:
+
+        """
+        for operation in sorted(self.completed(region, env, rtype)):
+            env_schema.update(self.load(region, env, rtype, operation))
+        return env_schema
+
+    def clear(self):
+        """
+        Remove the manifest and every checkpointed unit, then the directories they leave empty. Other files in the
+        checkpoint directory are kept
+
+        Returns:
+
+        """
+        unit_dirs = set()
+        for region, env, rtype, operation in list(self.iter_units()):
+            os.remove(os.path.join(self._unit_dir(region, env, rtype), f'{operation}.json'))
+            unit_dirs.add((region, env, rtype))
+        for region, env, rtype in unit_dirs:
+            for path in (self._unit_dir(region, env, rtype), os.path.join(self._directory, region, env),
+                         os.path.join(self._directory, region)):
+                if os.path.isdir(path) and not os.listdir(path):
+                    os.rmdir(path)
+        manifest = os.path.join(self._directory, self.MANIFEST)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        if os.path.isdir(self._directory) and not os.listdir(self._directory):
+            os.rmdir(self._directory)
+
+    @staticmethod
+    def _write(path, data):
+        """
+        Write JSON through a temporary file and an atomic swap, a crash never leaves a partial unit behind
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, default=str)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise e
@@ -0,0 +1,293 @@
+import json
+import logging
+import boto3
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# AWS Config resource types per boto3 client type, with the describe method and response key they stand in for
+RESOURCE_TYPES = {
+    'ec2': {
+        'AWS::EC2::VPC': ('describe_vpcs', 'Vpcs'),
+        'AWS::EC2::Subnet': ('describe_subnets', 'Subnets'),
+        'AWS::EC2::NetworkInterface': ('describe_network_interfaces', 'NetworkInterfaces'),
+        'AWS::EC2::Instance': ('describe_instances', 'Reservations'),
+        'AWS::EC2::RouteTable': ('describe_route_tables', 'RouteTables'),
+        'AWS::EC2::SecurityGroup': ('describe_security_groups', 'SecurityGroups'),
+        'AWS::EC2::NatGateway': ('describe_nat_gateways', 'NatGateways'),
+        'AWS::EC2::InternetGateway': ('describe_internet_gateways', 'InternetGateways'),
+        'AWS::EC2::VPNGateway': ('describe_vpn_gateways', 'VpnGateways'),
+        'AWS::EC2::EIP': ('describe_addresses', 'Addresses'),
+        'AWS::EC2::VPCEndpoint': ('describe_vpc_endpoints', 'VpcEndpoints'),
+        'AWS::EC2::TransitGateway': ('describe_transit_gateways', 'TransitGateways'),
+        'AWS::EC2::TransitGatewayAttachment': ('describe_transit_gateway_attachments', 'TransitGatewayAttachments'),
+        'AWS::EC2::TransitGatewayRouteTable': ('describe_transit_gateway_route_tables', 'TransitGatewayRouteTables'),
+    },
+    'elbv2': {
+        'AWS::ElasticLoadBalancingV2::LoadBalancer': ('describe_load_balancers', 'LoadBalancers'),
+    },
+}
+
+# Fields linking a normalized resource to the vpc, transit gateway and service ids of an environment
+AFFINITY_FIELDS = ('VpcId', 'TransitGatewayId', 'ServiceName')
+
+# Lists of VPC attachments, used by internet gateways and virtual private gateways
+ATTACHMENT_FIELDS = ('Attachments', 'VpcAttachments')
+
+# Elastic IPs have no VPC field, they are placed through the VPC of the interface or instance they are associated with
+EIP_TYPE = 'AWS::EC2::EIP'
+EIP_LOOKUP_TYPES = ('AWS::EC2::NetworkInterface', 'AWS::EC2::Instance')
+
+
+def pascal_case(element):
+    """
+    Convert the camelCase keys of an AWS Config configuration item to the PascalCase of the describe responses
+    Args:
+        element: Configuration dictionary, list or value
+
+    Returns:
+
+    """
+    if isinstance(element, dict):
+        return {k[:1].upper() + k[1:]: pascal_case(v) for k, v in element.items()}
+    if isinstance(element, list):
+        return [pascal_case(v) for v in element]
+    return element
+
+
+def select_resource_types(rtype, includes, excludes):
+    """
+    AWS Config resource types whose describe method is selected by the include and exclusion keywords
+    Args:
+        rtype: boto3 client type, ec2 or elbv2
+        includes: Include keywords from the definition file
+        excludes: Exclusion keywords from the definition file
+
+    Returns:
+        Dict of {AWS Config resource type: (describe method, response key)}
+
+    """
+    return {resource_type: (method, key) for resource_type, (method, key) in RESOURCE_TYPES.get(rtype, {}).items()
+            if any(i in method for i in includes) and not any(e in method for e in excludes or [] if e)}
+
+
+def unmapped_includes(rtype, includes, excludes):
+    """
+    Include keywords selecting no AWS Config resource type, the aws_config backend does not export them
+    Args:
+        rtype: boto3 client type, ec2 or elbv2
+        includes: Include keywords from the definition file
+        excludes: Exclusion keywords from the definition file
+
+    Returns:
+
+    """
+    methods = [method for method, _ in RESOURCE_TYPES.get(rtype, {}).values()
+               if not any(e in method for e in excludes or [] if e)]
+    return [i for i in includes if not any(i in method for method in methods)]
+
+
+def resource_affinity(resource_type, resource, vpcs_by_resource):
+    """
+    Vpc, transit gateway and service ids a normalized resource belongs to
+    Args:
+        resource_type: AWS Config resource type
+        resource: Normalized resource
+        vpcs_by_resource: Dict of {network interface or instance id: vpc id}, used to place elastic IPs
+
+    Returns:
+
+    """
+    affinity = {resource.get(field) for field in AFFINITY_FIELDS}
+    for field in ATTACHMENT_FIELDS:
+        for attachment in resource.get(field) or []:
+            affinity.add(attachment.get('VpcId'))
+    if resource_type == EIP_TYPE:
+        affinity.update(vpcs_by_resource.get(resource.get(k)) for k in ('NetworkInterfaceId', 'InstanceId'))
+    affinity.discard(None)
+    return affinity
+
+
+def normalize_resource(result):
+    """
+    Normalize an advanced query result into the describe response shape the Visualizer expects
+    Args:
+        result: Row of select_aggregate_resource_config, decoded from JSON
+
+    Returns:
+
+    """
+    configuration = result.get('configuration') or {}
+    if isinstance(configuration, str):
+        configuration = json.loads(configuration)
+    resource = pascal_case(configuration)
+    if 'Tags' not in resource:
+        resource['Tags'] = pascal_case(result.get('tags') or [])
+    if result.get('resourceType') == 'AWS::EC2::RouteTable':
+        for association in resource.get('Associations') or []:
+            # Older configuration items do not record the association state
+            association.setdefault('AssociationState', {'State': 'associated'})
+    return resource
+
+
+class AwsConfigBackend:
+    """
+    Export through one paginated AWS Config advanced query against an aggregator instead of per method describes
+    """
+    def __init__(self, aggregator_name, client, accounts=None, page_size=100):
+        self._aggregator_name = aggregator_name
+        self._client = client
+        self._accounts = accounts or []
+        self._page_size = page_size
+
+    @classmethod
+    def from_definition(cls, config):
+        """
+        Create the backend from the aws_config block of a definition file
+        Args:
+            config: Loaded definition file
+
+        Returns:
+
+        """
+        options = config.get('aws_config') or {}
+        if not options.get('aggregator_name'):
+            raise ValueError('aws_config.aggregator_name is required for the aws_config backend')
+        if config.get('aws_profile'):
+            session = boto3.Session(profile_name=config['aws_profile'], region_name=options.get('region'))
+        else:
+            # Assumes Metadata Credentials
+            session = boto3.Session(region_name=options.get('region'))
+        return cls(options['aggregator_name'], session.client('config'), accounts=options.get('accounts'))
+
+    def build_expression(self, resource_types, regions):
+        """
+        Build the advanced query selecting every requested resource type in the requested regions
+        Args:
+            resource_types: AWS Config resource types
+            regions: AWS Regions
+
+        Returns:
+
+        """
+        def quoted(values):
+            return ', '.join(f"'{v}'" for v in sorted(values))
+
+        expression = (f'SELECT resourceId, resourceType, awsRegion, accountId, configuration, tags '
+                      f'WHERE resourceType IN ({quoted(resource_types)}) AND awsRegion IN ({quoted(regions)})')
+        if self._accounts:
+            expression += f' AND accountId IN ({quoted(self._accounts)})'
+        return expression
+
+    def select(self, expression):
+        """
+        Run an advanced query against the aggregator, following NextToken
+        Args:
+            expression: AWS Config SQL expression
+
+        Returns:
+            Generator of decoded result rows
+
+        """
+        kwargs = {'Expression': expression, 'ConfigurationAggregatorName': self._aggregator_name,
+                  'Limit': self._page_size}
+        while True:
+            response = self._client.select_aggregate_resource_config(**kwargs)
+            for result in response.get('Results', []):
+                yield json.loads(result)
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+    def export(self, config, schema):
+        """
+        Populate the export schema for every region and environment of a definition with a single query
+        Args:
+            config: Loaded definition file
+            schema: Export schema from new_export_schema
+
+        Returns:
+
+        """
+        wanted = {}
+        environments = []
+        includes = {}
+        for region in config["regions"]:
+            for rk in region:
+                schema['regions'].update({rk: {}})
+                for env, attrs in region[rk].items():
+                    schema['regions'][rk].update({env: {}})
+                    selected = {}
+                    for rtype in attrs.get('resource_types') or []:
+                        if rtype == 'ec2':
+                            includes[rtype] = (config['ec2_includes'], config.get('ec2_exclusions'))
+                        elif rtype == 'elbv2':
+                            includes[rtype] = (config['elb_includes'], config.get('elb_exclusions'))
+                        else:
+                            raise ValueError(f'Unsupported aws resource type: {rtype}')
+                        selected.update(select_resource_types(rtype, *includes[rtype]))
+                    for _, key in selected.values():
+                        schema['regions'][rk][env][key] = []
+                    wanted.update(selected)
+                    ids = set(attrs.get('vpc_ids') or []) | set(attrs.get('tgw_ids') or []) | set(
+                        attrs.get('service_names') or [])
+                    environments.append((rk, env, ids, selected))
+        for rtype, (rtype_includes, rtype_excludes) in includes.items():
+            for keyword in unmapped_includes(rtype, rtype_includes, rtype_excludes):
+                logger.warning(f'Include {keyword} for the {rtype} client has no AWS Config resource type, it is not '
+                               f'exported by the aws_config backend')
+
+        if not wanted:
+            return schema
+        query_types = set(wanted)
+        if EIP_TYPE in wanted:
+            query_types.update(EIP_LOOKUP_TYPES)
+        expression = self.build_expression(query_types, schema['regions'])
+        logger.info(f'Querying AWS Config aggregator {self._aggregator_name}')
+        # Resources are placed as the pages stream in, only elastic IPs wait for the VPCs of the interfaces and
+        # instances returned on any page
+        eips = []
+        vpcs_by_resource = {}
+        count = 0
+        for result in self.select(expression):
+            resource = normalize_resource(result)
+            resource_type = result.get('resourceType')
+            if EIP_TYPE in wanted and resource_type in EIP_LOOKUP_TYPES and resource.get('VpcId'):
+                vpcs_by_resource[result.get('resourceId')] = resource['VpcId']
+            if resource_type == EIP_TYPE:
+                eips.append((result, resource))
+            elif resource_type in wanted:
+                self.place(schema, environments, result, resource, vpcs_by_resource)
+                count += 1
+        for result, resource in eips:
+            self.place(schema, environments, result, resource, vpcs_by_resource)
+        logger.info(f'Normalized {count + len(eips)} resources from AWS Config')
+        return schema
+
+    @staticmethod
+    def place(schema, environments, result, resource, vpcs_by_resource):
+        """
+        Append a normalized resource to every environment it belongs to
+        Args:
+            schema: Export schema
+            environments: List of (region, environment, ids, selected resource types)
+            result: Row of select_aggregate_resource_config, decoded from JSON
+            resource: Normalized resource
+            vpcs_by_resource: Dict of {network interface or instance id: vpc id}, used to place elastic IPs
+
+        Returns:
+
+        """
+        resource_type = result.get('resourceType')
+        affinity = resource_affinity(resource_type, resource, vpcs_by_resource) | {result.get('resourceId')}
+        for rk, env, ids, selected in environments:
+            if rk != result.get('awsRegion') or resource_type not in selected or not ids & affinity:
+                continue
+            key = selected[resource_type][1]
+            if key == 'Reservations':
+                if not schema['regions'][rk][env][key]:
+                    schema['regions'][rk][env][key].append({'Instances': []})
+                schema['regions'][rk][env][key][0]['Instances'].append(resource)
+            else:
+                schema['regions'][rk][env][key].append(resource)
@@ -0,0 +1,256 @@
+import bisect
+import ipaddress
+import json
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# Identifier fields that do not follow the <singular resource>Id naming of the describe responses
+ID_FIELDS = {
+    'Addresses': 'AllocationId',
+    'SecurityGroups': 'GroupId',
+    'ServiceDetails': 'ServiceId',
+    'TransitGatewayVpcAttachments': 'TransitGatewayAttachmentId',
+    'TransitGatewayPeeringAttachments': 'TransitGatewayAttachmentId',
+}
+
+# Fields holding an address or CIDR that places a resource inside a network
+ADDRESS_FIELDS = ('CidrBlock', 'Ipv6CidrBlock', 'PrivateIpAddress', 'PublicIp', 'PublicIpAddress', 'Ipv6Address',
+                  'CarrierIp', 'CustomerOwnedIp')
+
+TAG_FIELDS = ('Tags', 'TagSet')
+
+
+def parse_tag_filter(tag):
+    """
+    Parse a CLI tag filter
+    Args:
+        tag: 'key=value' or 'key' to match any value
+
+    Returns:
+        Tuple of (key, value), value is None when only the key was given
+
+    """
+    if '=' in tag:
+        key, value = tag.split('=', 1)
+        return key, value
+    return tag, None
+
+
+class ExportIndex:
+    """
+    Hash and interval indexes over an exported AWS configuration, loaded once and queried many times
+    """
+    def __init__(self):
+        self._records = []
+        self._ids = {}
+        self._types = {}
+        self._regions = {}
+        self._envs = {}
+        self._tags = {}
+        self._tag_keys = {}
+        self._pending_intervals = {4: [], 6: []}
+        self._interval_starts = {4: [], 6: []}
+        self._intervals = {4: [], 6: []}
+
+    def __len__(self):
+        return len(self._records)
+
+    @classmethod
+    def from_file(cls, filepath):
+        """
+        Load an export file and build its indexes
+        Args:
+            filepath: JSON file generated by the exporter
+
+        Returns:
+
+        """
+        with open(filepath) as f:
+            return cls.from_schema(json.load(f))
+
+    @classmethod
+    def from_schema(cls, schema):
+        """
+        Build indexes from an export schema
+        Args:
+            schema: Export dictionary with regions -> environments -> response keys
+
+        Returns:
+
+        """
+        index = cls()
+        for rk, rv in schema['regions'].items():
+            for ek, ev in rv.items():
+                for resource_type, items in ev.items():
+                    if not isinstance(items, list):
+                        continue
+                    for item in items:
+                        if not isinstance(item, dict):
+                            continue
+                        if resource_type == 'Reservations':
+                            # Instances are the resources, reservations only group them
+                            for instance in item.get('Instances', []):
+                                index.add(rk, ek, 'Instances', instance)
+                        else:
+                            index.add(rk, ek, resource_type, item)
+        index.build()
+        logger.info(f'Indexed {len(index)} resources')
+        return index
+
+    def add(self, region, env, resource_type, resource):
+        """
+        Add a resource to the indexes, call build once every resource was added
+        Args:
+            region: AWS Region
+            env: Environment name
+            resource_type: Response key of the describe method, e.g. NetworkInterfaces
+            resource: Resource dictionary from the describe response
+
+        Returns:
+
+        """
+        pos = len(self._records)
+        self._records.append((region, env, resource_type, resource))
+        self._types.setdefault(resource_type, set()).add(pos)
+        self._regions.setdefault(region, set()).add(pos)
+        self._envs.setdefault(env, set()).add(pos)
+        for resource_id in self.resource_ids(resource_type, resource):
+            self._ids.setdefault(resource_id, set()).add(pos)
+        for field in TAG_FIELDS:
+            for tag in resource.get(field) or []:
+                if isinstance(tag, dict) and 'Key' in tag:
+                    self._tag_keys.setdefault(tag['Key'], set()).add(pos)
+                    self._tags.setdefault((tag['Key'], tag.get('Value')), set()).add(pos)
+        for address in self._addresses(resource):
+            try:
+                network = ipaddress.ip_network(address, strict=False)
+            except ValueError:
+                continue
+            self._pending_intervals[network.version].append(
+                (int(network.network_address), int(network.broadcast_address), pos))
+
+    def build(self):
+        """
+        Sort the address intervals so CIDR containment is answered with a binary search
+
+        Returns:
+
+        """
+        for version, pending in self._pending_intervals.items():
+            intervals = sorted(self._intervals[version] + pending)
+            self._intervals[version] = intervals
+            self._interval_starts[version] = [interval[0] for interval in intervals]
+            self._pending_intervals[version] = []
+
+    @staticmethod
+    def resource_ids(resource_type, resource):
+        """
+        Identifiers of a resource, e.g. the VpcId of a Vpc or the LoadBalancerArn of a LoadBalancer
+        Args:
+            resource_type: Response key of the describe method
+            resource: Resource dictionary
+
+        Returns:
+
+        """
+        singular = resource_type[:-1] if resource_type.endswith('s') else resource_type
+        fields = (ID_FIELDS.get(resource_type), f'{singular}Id', f'{singular}Arn')
+        return [resource[field] for field in fields if field and isinstance(resource.get(field), str)]
+
+    @staticmethod
+    def _addresses(resource):
+        """
+        Collect every address and CIDR of a resource, including nested interfaces and associations
+        Args:
+            resource: Resource dictionary
+
+        Returns:
+
+        """
+        addresses = []
+        stack = [resource]
+        while stack:
+            element = stack.pop()
+            if isinstance(element, dict):
+                for k, v in element.items():
+                    if k in ADDRESS_FIELDS and isinstance(v, str):
+                        addresses.append(v)
+                    elif isinstance(v, (dict, list)):
+                        stack.append(v)
+            elif isinstance(element, list):
+                stack.extend(element)
+        return addresses
+
+    def _within(self, cidr):
+        """
+        Resources with at least one address or CIDR inside a network
+        Args:
+            cidr: Network in CIDR notation
+
+        Returns:
+
+        """
+        network = ipaddress.ip_network(cidr, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        starts = self._interval_starts[network.version]
+        intervals = self._intervals[network.version]
+        lo = bisect.bisect_left(starts, first)
+        hi = bisect.bisect_right(starts, last)
+        return {pos for _, end, pos in intervals[lo:hi] if end <= last}
+
+    def get(self, resource_id):
+        """
+        Lookup resources by identifier
+        Args:
+            resource_id: Resource ID or ARN
+
+        Returns:
+
+        """
+        return [self._record(pos) for pos in sorted(self._ids.get(resource_id, ()))]
+
+    def query(self, resource_type=None, tags=None, cidr=None, region=None, env=None, resource_id=None):
+        """
+        Find the resources matching every given criteria
+        Args:
+            resource_type: Response key of the describe method, e.g. NetworkInterfaces or Instances
+            tags: Dict of {key: value}, a None value matches any value of the key
+            cidr: Only resources with an address or CIDR inside this network
+            region: AWS Region
+            env: Environment name
+            resource_id: Resource ID or ARN
+
+        Returns:
+            List of dicts with region, env, resource_type and resource
+
+        """
+        candidates = []
+        if resource_id is not None:
+            candidates.append(self._ids.get(resource_id, set()))
+        if resource_type is not None:
+            candidates.append(self._types.get(resource_type, set()))
+        if region is not None:
+            candidates.append(self._regions.get(region, set()))
+        if env is not None:
+            candidates.append(self._envs.get(env, set()))
+        for key, value in (tags or {}).items():
+            if value is None:
+                candidates.append(self._tag_keys.get(key, set()))
+            else:
+                candidates.append(self._tags.get((key, value), set()))
+        if cidr is not None:
+            candidates.append(self._within(cidr))
+        if not candidates:
+            matches = range(len(self._records))
+        else:
+            # Intersect starting from the most selective index
+            candidates.sort(key=len)
+            matches = sorted(candidates[0].intersection(*candidates[1:]))
+        return [self._record(pos) for pos in matches]
+
+    def _record(self, pos):
+        region, env, resource_type, resource = self._records[pos]
+        return {'region': region, 'env': env, 'resource_type': resource_type, 'resource': resource}
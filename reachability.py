@@ -0,0 +1,264 @@
+import ipaddress
+import socket
+import logging
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# Route target fields in order of precedence, the first one present is the next hop
+NEXT_HOP_FIELDS = ('TransitGatewayId', 'GatewayId', 'NatGatewayId', 'NetworkInterfaceId', 'VpcPeeringConnectionId',
+                   'InstanceId', 'LocalGatewayId', 'CarrierGatewayId', 'EgressOnlyInternetGatewayId', 'CoreNetworkArn')
+
+BLACKHOLE = 'blackhole'
+NO_ROUTE = -1
+
+
+def ip_to_int(addresses):
+    """
+    Convert IPv4 addresses to a uint64 array, parsing every distinct address only once
+    Args:
+        addresses: Sequence of dotted quad strings or integers
+
+    Returns:
+
+    """
+    addresses = np.asarray(addresses)
+    if addresses.dtype.kind in 'iu':
+        return addresses.astype(np.uint64)
+    unique, inverse = np.unique(addresses, return_inverse=True)
+    parsed = np.fromiter((int.from_bytes(socket.inet_aton(str(a)), 'big') for a in unique),
+                         dtype=np.uint64, count=len(unique))
+    return parsed[inverse.reshape(-1)]
+
+
+class RouteReachability:
+    """
+    Longest prefix match over every VPC and transit gateway route table of an export, compiled into sorted NumPy
+    arrays so millions of (source subnet, destination IP) pairs are resolved in batch
+    """
+    def __init__(self):
+        self.route_tables = []
+        self.next_hops = []
+        self._table_codes = {}
+        self._hop_codes = {}
+        self._routes = []
+        self._subnet_tables = {}
+        self._subnet_vpcs = {}
+        self._main_tables = {}
+        self._tgw_tables = {}
+        self._tgw_hops = None
+        self._keys = {}
+        self._hops = {}
+
+    @classmethod
+    def from_schema(cls, schema):
+        """
+        Compile the route tables of an export schema
+        Args:
+            schema: Export dictionary with regions -> environments -> response keys
+
+        Returns:
+
+        """
+        reachability = cls()
+        for rk, rv in schema['regions'].items():
+            for ek, ev in rv.items():
+                for subnet in ev.get('Subnets') or []:
+                    reachability._subnet_vpcs[subnet['SubnetId']] = subnet['VpcId']
+                for rt in ev.get('RouteTables') or []:
+                    reachability.add_route_table(rt)
+                for attachment in ev.get('TransitGatewayAttachments') or []:
+                    reachability.add_transit_gateway_attachment(attachment)
+                for tgw_rt in ev.get('TransitGatewayRouteTables') or []:
+                    reachability.add_transit_gateway_route_table(tgw_rt)
+        reachability.compile()
+        logger.info(f'Compiled {len(reachability._routes)} routes from {len(reachability.route_tables)} route tables')
+        return reachability
+
+    def _table_code(self, table_id):
+        if table_id not in self._table_codes:
+            self._table_codes[table_id] = len(self.route_tables)
+            self.route_tables.append(table_id)
+        return self._table_codes[table_id]
+
+    def _hop_code(self, hop):
+        if hop not in self._hop_codes:
+            self._hop_codes[hop] = len(self.next_hops)
+            self.next_hops.append(hop)
+        return self._hop_codes[hop]
+
+    def _add_route(self, table, cidr, hop):
+        try:
+            network = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            return
+        if network.version != 4:
+            return
+        self._routes.append((table, int(network.network_address), network.prefixlen, self._hop_code(hop)))
+
+    def add_route_table(self, rt):
+        """
+        Add a VPC route table from describe_route_tables
+        Args:
+            rt: Route table dictionary
+
+        Returns:
+
+        """
+        if rt['RouteTableId'] in self._table_codes:
+            return
+        table = self._table_code(rt['RouteTableId'])
+        for association in rt.get('Associations') or []:
+            if association.get('Main'):
+                self._main_tables[rt['VpcId']] = table
+            elif 'SubnetId' in association:
+                self._subnet_tables[association['SubnetId']] = table
+        for route in rt.get('Routes') or []:
+            if 'DestinationCidrBlock' not in route:
+                # IPv6 and prefix list destinations are not compiled
+                continue
+            if route.get('State') == BLACKHOLE:
+                hop = BLACKHOLE
+            else:
+                hop = next((route[field] for field in NEXT_HOP_FIELDS if field in route), None)
+            if hop is not None:
+                self._add_route(table, route['DestinationCidrBlock'], hop)
+
+    def add_transit_gateway_attachment(self, attachment):
+        """
+        Map a VPC attachment from describe_transit_gateway_attachments to its associated transit gateway route table
+        Args:
+            attachment: Transit gateway attachment dictionary
+
+        Returns:
+
+        """
+        association = attachment.get('Association') or {}
+        if attachment.get('ResourceType') == 'vpc' and 'TransitGatewayRouteTableId' in association:
+            self._tgw_tables[(attachment['TransitGatewayId'], attachment['ResourceId'])] = self._table_code(
+                association['TransitGatewayRouteTableId'])
+
+    def add_transit_gateway_route_table(self, tgw_rt):
+        """
+        Add the routes of a transit gateway route table. describe_transit_gateway_route_tables does not return routes,
+        they are compiled when the table carries a Routes list shaped like search_transit_gateway_routes
+        Args:
+            tgw_rt: Transit gateway route table dictionary
+
+        Returns:
+
+        """
+        table = self._table_code(tgw_rt['TransitGatewayRouteTableId'])
+        for route in tgw_rt.get('Routes') or []:
+            if 'DestinationCidrBlock' not in route:
+                continue
+            if route.get('State') == BLACKHOLE:
+                hop = BLACKHOLE
+            else:
+                attachments = route.get('TransitGatewayAttachments') or [{}]
+                hop = attachments[0].get('ResourceId') or attachments[0].get('TransitGatewayAttachmentId')
+            if hop is not None:
+                self._add_route(table, route['DestinationCidrBlock'], hop)
+
+    def compile(self):
+        """
+        Build one sorted (route table, network) key array per prefix length
+
+        Returns:
+
+        """
+        self._keys = {}
+        self._hops = {}
+        if self._routes:
+            routes = np.array(self._routes, dtype=np.uint64)
+            keys = (routes[:, 0] << np.uint64(32)) | routes[:, 1]
+            for length in np.unique(routes[:, 2]):
+                selected = routes[:, 2] == length
+                # The first route wins when a table carries the same prefix twice
+                length_keys, first = np.unique(keys[selected], return_index=True)
+                self._keys[int(length)] = length_keys
+                self._hops[int(length)] = routes[selected, 3][first].astype(np.int64)
+        self._tgw_hops = np.array([hop.startswith('tgw-') for hop in self.next_hops] + [False], dtype=bool)
+
+    def longest_prefix_match(self, tables, destinations):
+        """
+        Resolve the next hop of each (route table code, destination) pair
+        Args:
+            tables: Route table codes, NO_ROUTE entries are skipped
+            destinations: uint64 IPv4 addresses
+
+        Returns:
+            Next hop codes, NO_ROUTE where no route matches
+
+        """
+        tables = np.asarray(tables, dtype=np.int64)
+        destinations = np.asarray(destinations, dtype=np.uint64)
+        result = np.full(len(tables), NO_ROUTE, dtype=np.int64)
+        unresolved = np.flatnonzero(tables != NO_ROUTE)
+        table_keys = tables.astype(np.uint64) << np.uint64(32)
+        for length in sorted(self._keys, reverse=True):
+            if unresolved.size == 0:
+                break
+            mask = np.uint64((0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF)
+            query = table_keys[unresolved] | (destinations[unresolved] & mask)
+            keys = self._keys[length]
+            pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+            found = keys[pos] == query
+            result[unresolved[found]] = self._hops[length][pos[found]]
+            unresolved = unresolved[~found]
+        return result
+
+    def lookup(self, subnets, destinations):
+        """
+        Resolve the VPC route table hop, and when it is a transit gateway, the transit gateway route table hop, for
+        every (source subnet, destination IP) pair
+        Args:
+            subnets: Sequence of source subnet IDs
+            destinations: Sequence of IPv4 addresses, as strings or integers
+
+        Returns:
+            Dict of code arrays: route_table, next_hop, tgw_route_table and tgw_next_hop, decode them with labels
+
+        """
+        unique_subnets, inverse = np.unique(np.asarray(subnets), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        destinations = ip_to_int(destinations)
+        subnet_tables = np.array([self._subnet_route_table(s) for s in unique_subnets], dtype=np.int64)
+        tables = subnet_tables[inverse]
+        hops = self.longest_prefix_match(tables, destinations)
+
+        # Second hop through the transit gateway route table associated with the source VPC attachment
+        tgw_tables = np.full(len(hops), NO_ROUTE, dtype=np.int64)
+        tgw = np.flatnonzero(self._tgw_hops[hops])
+        if tgw.size:
+            pairs, pair_inverse = np.unique(np.stack([hops[tgw], inverse[tgw]], axis=1), axis=0, return_inverse=True)
+            pair_tables = np.array([self._tgw_tables.get((self.next_hops[hop], self._subnet_vpcs.get(
+                str(unique_subnets[subnet]))), NO_ROUTE) for hop, subnet in pairs], dtype=np.int64)
+            tgw_tables[tgw] = pair_tables[pair_inverse.reshape(-1)]
+        tgw_hops = self.longest_prefix_match(tgw_tables, destinations)
+        return {'route_table': tables, 'next_hop': hops, 'tgw_route_table': tgw_tables, 'tgw_next_hop': tgw_hops}
+
+    def _subnet_route_table(self, subnet_id):
+        """
+        Explicitly associated route table of a subnet, falling back to the main route table of its VPC
+        """
+        subnet_id = str(subnet_id)
+        if subnet_id in self._subnet_tables:
+            return self._subnet_tables[subnet_id]
+        return self._main_tables.get(self._subnet_vpcs.get(subnet_id), NO_ROUTE)
+
+    def labels(self, codes, kind='next_hop'):
+        """
+        Decode route table or next hop codes returned by lookup
+        Args:
+            codes: Code array
+            kind: 'next_hop' or 'route_table'
+
+        Returns:
+            Object array of IDs, None where there is no route
+
+        """
+        names = self.next_hops if kind == 'next_hop' else self.route_tables
+        return np.array(names + [None], dtype=object)[np.asarray(codes)]
@@ -0,0 +1,74 @@
+# Timing benchmark for the static diagram export at increasing graph sizes
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from visualize import Visualizer, STATIC_ENGINES  # noqa: E402
+
+
+def build_graph(nodes, subnets_per_vpc=4, instances_per_subnet=20):
+    """
+    Build a synthetic region -> environment -> vpc -> subnet -> instance graph of about the requested size
+
+    Args:
+        nodes: Approximate number of nodes
+        subnets_per_vpc: Subnets in each VPC
+        instances_per_subnet: Instances in each subnet
+
+    Returns:
+
+    """
+    network = Visualizer()
+    network.set_header({'cloud_provider': 'aws', 'customer': 'benchmark'})
+    vpc_size = 1 + subnets_per_vpc * (1 + instances_per_subnet)
+    for v in range(max(1, nodes // vpc_size)):
+        network.region_name = f'region-{v % 4}'
+        network.vpc_id = None
+        network.add_node_edge(network.region_name, None, None)
+        network.add_node_edge('dev', network.region_name, 'dev')
+        network.vpc_id = f'vpc-{v}'
+        network.add_node_edge(network.vpc_id, 'dev', network.vpc_id, title=f'id: {network.vpc_id}')
+        for s in range(subnets_per_vpc):
+            subnet = f'subnet-{v}-{s}'
+            network.add_node_edge(subnet, network.vpc_id, subnet, title=f'cidr: 10.{v % 256}.{s}.0/24')
+            for i in range(instances_per_subnet):
+                instance = f'i-{v}-{s}-{i}'
+                network.add_node_edge(instance, subnet, instance, title=f'id: {instance}\ntype: m5.large')
+    return network
+
+
+@click.command()
+@click.option('--sizes', default='1000,10000,50000,100000', help='Comma separated graph sizes in nodes')
+@click.option('--engine', type=click.Choice(STATIC_ENGINES), default='sfdp', help='Layout engine')
+@click.option('--layout/--no-layout', default=True, help='Also time the Graphviz layout when the engine is installed')
+def main(sizes, engine, layout):
+    logging.disable(logging.INFO)
+    layout = layout and shutil.which(engine) is not None
+    directory = tempfile.mkdtemp()
+    try:
+        click.echo(f'{"nodes":>8} {"edges":>8} {"dot write (s)":>14} {f"{engine} svg (s)":>14}')
+        for size in (int(s) for s in sizes.split(',')):
+            network = build_graph(size)
+            graph = network._graph
+            filepath = os.path.join(directory, f'diagram-{size}')
+            start = time.perf_counter()
+            network.write_dot(f'{filepath}.dot')
+            written = time.perf_counter() - start
+            rendered = 'skipped'
+            if layout:
+                start = time.perf_counter()
+                network.render_static(filepath, engine=engine, fmt='svg')
+                rendered = f'{time.perf_counter() - start:.2f}'
+            click.echo(f'{graph.number_of_nodes():>8} {graph.number_of_edges():>8} {written:>14.3f} {rendered:>14}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,585 @@ from unittest.mock import Mock
 from unittest.mock import call
 from unittest.mock import ANY
 from unittest.mock import mock_open
+import json
+import os
+import shutil
+import tempfile
+from functools import partial
 
+import boto3
+import aws_config_exporter
+import watch
+import query
+import reachability
+import checkpoint
+import config_backend
+import visualize
+from visualize import Visualizer
+
+DEFINITIONS_EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                   'definitions_example.yaml')
+
+
+class TestUnfilteredIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.response = {
+            'LoadBalancers': [
+                {'LoadBalancerArn': 'arn-1', 'VpcId': 'vpc-1'},
+                {'LoadBalancerArn': 'arn-2', 'VpcId': 'vpc-2'},
+                {'LoadBalancerArn': 'arn-3', 'VpcId': 'vpc-1'},
+            ],
+            'NextMarker': 'token'
+        }
+
+    def test_lookup_returns_matches_in_response_order(self):
+        index = aws_config_exporter.build_filter_index(self.response, ['VpcId'])
+        matches = aws_config_exporter.lookup_filter_index(self.response['LoadBalancers'], index['LoadBalancers'],
+                                                          {'VpcId': ['vpc-1', 'vpc-3']})
+        self.assertEqual([m['LoadBalancerArn'] for m in matches], ['arn-1', 'arn-3'])
+        self.assertNotIn('NextMarker', index)
+
+    def test_unfiltered_method_fetched_once_per_run(self):
+        method = MagicMock(return_value=dict(self.response, ResponseMetadata={}))
+        method.__doc__ = None
+        client = Mock(spec=['describe_load_balancers'])
+        client.describe_load_balancers = method
+        cache = {}
+        with patch.object(aws_config_exporter.boto3, 'Session') as session:
+            session.return_value.client.return_value = client
+            for vpc_ids, arns in ((['vpc-1'], ['arn-1', 'arn-3']), (['vpc-2'], ['arn-2'])):
+                result = aws_config_exporter.export_aws_config(schema={}, keywords=['_load_balancers'], excludes=[],
+                                                               resource_type='elbv2', cache=cache, VpcId=vpc_ids)
+                self.assertEqual([lb['LoadBalancerArn'] for lb in result['LoadBalancers']], arns)
+        method.assert_called_once_with()
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+        def sleep(seconds):
+            self.now += seconds
+
+        self.scheduler = watch.RefreshScheduler(stagger=5, clock=lambda: self.now, sleep=sleep)
+
+    def test_refreshes_are_staggered_and_follow_intervals(self):
+        self.scheduler.add('vpcs', 3600)
+        self.scheduler.add('instances', 60)
+        refreshed = []
+        self.scheduler.run(lambda unit: refreshed.append((unit, self.now)), Mock(), max_refreshes=4)
+        self.assertEqual(refreshed, [('instances', 0.0), ('vpcs', 5.0), ('instances', 60.0), ('instances', 120.0)])
+
+    def test_failed_refresh_is_rescheduled(self):
+        self.scheduler.add('instances', 60)
+        refresh = Mock(side_effect=[Exception('throttled'), None])
+        publish = Mock()
+        self.scheduler.run(refresh, publish, max_refreshes=2)
+        self.assertEqual(refresh.call_count, 2)
+        publish.assert_called_once_with(['instances'])
+
+    def test_publish_failure_is_reported_separately(self):
+        self.scheduler.add('instances', 60)
+        refresh = Mock()
+        publish = Mock(side_effect=KeyError('Vpcs'))
+        with self.assertLogs('watch', level='ERROR') as logs:
+            self.scheduler.run(refresh, publish, max_refreshes=2)
+        self.assertEqual(refresh.call_count, 2)
+        self.assertEqual(publish.call_count, 2)
+        self.assertTrue(all('failed to publish' in line for line in logs.output))
+        self.assertFalse(any('Failed to refresh' in line for line in logs.output))
+
+    def test_publishes_are_coalesced(self):
+        scheduler = watch.RefreshScheduler(stagger=5, publish_interval=30, clock=lambda: self.now,
+                                           sleep=self.scheduler._sleep)
+        for unit in ('a', 'b', 'c'):
+            scheduler.add(unit, 60)
+        published = []
+        scheduler.run(Mock(), lambda units: published.append((units, self.now)), max_refreshes=6)
+        # b and c are published while the loop waits for the next round, not after each refresh
+        self.assertEqual(published, [(['a'], 0.0), (['b', 'c'], 30.0), (['a'], 60.0), (['b', 'c'], 70.0)])
+
+    def test_seeded_units_wait_for_their_interval(self):
+        self.scheduler.add('instances', 60)
+        refreshed = []
+        self.scheduler.run(lambda unit: refreshed.append(self.now), Mock(), max_refreshes=1, seeded=True)
+        self.assertEqual(refreshed, [60.0])
+
+    def test_saturated_schedule_does_not_starve_long_intervals(self):
+        for position in range(70):
+            self.scheduler.add(f'instances-{position}', 300)
+        self.scheduler.add('vpcs', 3600)
+        refreshed = []
+        with self.assertLogs('watch', level='WARNING') as logs:
+            self.scheduler.run(lambda unit: refreshed.append((unit, self.now)), Mock(), max_refreshes=5000)
+        self.assertTrue(any('refreshes will run late' in line for line in logs.output))
+        vpcs = [now for unit, now in refreshed if unit == 'vpcs']
+        self.assertGreater(len(vpcs), 1)
+        # Once due, vpcs waits at most one round of the 71 units
+        self.assertLessEqual(max(b - a for a, b in zip(vpcs, vpcs[1:])), 3600 + 71 * 5)
+
+
+class TestWatchExport(unittest.TestCase):
+
+    def setUp(self):
+        # watch writes its outputs to the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_watch_seeds_full_export_before_scheduling(self):
+        with patch.object(aws_config_exporter, 'export_resource_type',
+                          return_value={'Vpcs': [], 'Subnets': []}) as export, \
+                patch.object(aws_config_exporter, 'init_visualization') as init_visualization, \
+                patch.object(aws_config_exporter.RefreshScheduler, 'run') as run:
+            aws_config_exporter.watch_aws_export(DEFINITIONS_EXAMPLE)
+        self.assertTrue(all('keywords' not in c[1] for c in export.call_args_list))
+        schema = init_visualization.call_args[0][0]
+        self.assertEqual(schema['regions']['us-east-2']['dev'], {'Vpcs': [], 'Subnets': []})
+        self.assertTrue(run.call_args[1]['seeded'])
+
+
+class TestExportIndex(unittest.TestCase):
+
+    def setUp(self):
+        schema = {
+            'regions': {
+                'us-east-2': {
+                    'prod': {
+                        'Vpcs': [{'VpcId': 'vpc-1', 'CidrBlock': '10.20.0.0/16', 'Tags': []}],
+                        'NetworkInterfaces': [
+                            {'NetworkInterfaceId': 'eni-1', 'PrivateIpAddress': '10.20.1.10',
+                             'Tags': [{'Key': 'Name', 'Value': 'fw'}, {'Key': 'env', 'Value': 'prod'}]},
+                            {'NetworkInterfaceId': 'eni-2', 'PrivateIpAddress': '10.30.1.10',
+                             'Tags': [{'Key': 'env', 'Value': 'prod'}]},
+                            {'NetworkInterfaceId': 'eni-3', 'PrivateIpAddress': '10.20.2.10',
+                             'PrivateIpAddresses': [{'PrivateIpAddress': '10.20.2.10'}],
+                             'Tags': [{'Key': 'env', 'Value': 'dev'}]},
+                        ],
+                        'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'PrivateIpAddress': '10.20.1.10'}]}],
+                    }
+                }
+            }
+        }
+        self.index = query.ExportIndex.from_schema(schema)
+
+    def test_query_by_type_cidr_and_tag(self):
+        results = self.index.query(resource_type='NetworkInterfaces', cidr='10.20.0.0/16', tags={'env': 'prod'})
+        self.assertEqual([r['resource']['NetworkInterfaceId'] for r in results], ['eni-1'])
+
+    def test_cidr_containment_excludes_enclosing_networks(self):
+        results = self.index.query(cidr='10.20.1.0/24')
+        self.assertEqual(sorted(r['resource_type'] for r in results), ['Instances', 'NetworkInterfaces'])
+
+    def test_get_by_id(self):
+        self.assertEqual(self.index.get('i-1')[0]['resource_type'], 'Instances')
+        self.assertEqual(self.index.query(resource_id='vpc-1', tags={'env': None}), [])
+
+    def test_lookup_if_tag_exists_checks_every_tag(self):
+        tags = [{'Key': 'env', 'Value': 'prod'}, {'Key': 'Name', 'Value': 'fw'}]
+        self.assertEqual(Visualizer().lookup_if_tag_exists(tags, 'Name', 'eni-1'), 'fw')
+
+
+class TestRouteReachability(unittest.TestCase):
+
+    def setUp(self):
+        schema = {
+            'regions': {
+                'us-east-2': {
+                    'dev': {
+                        'Subnets': [{'SubnetId': 'subnet-a', 'VpcId': 'vpc-1'},
+                                    {'SubnetId': 'subnet-b', 'VpcId': 'vpc-1'}],
+                        'RouteTables': [
+                            {'RouteTableId': 'rtb-main', 'VpcId': 'vpc-1', 'Associations': [{'Main': True}],
+                             'Routes': [{'DestinationCidrBlock': '10.1.0.0/16', 'GatewayId': 'local'}]},
+                            {'RouteTableId': 'rtb-a', 'VpcId': 'vpc-1',
+                             'Associations': [{'Main': False, 'SubnetId': 'subnet-a'}],
+                             'Routes': [{'DestinationCidrBlock': '10.1.0.0/16', 'GatewayId': 'local'},
+                                        {'DestinationCidrBlock': '10.0.0.0/8', 'TransitGatewayId': 'tgw-1'},
+                                        {'DestinationCidrBlock': '0.0.0.0/0', 'NatGatewayId': 'nat-1'},
+                                        {'DestinationCidrBlock': '10.9.0.0/16', 'State': 'blackhole'}]},
+                        ],
+                        'TransitGatewayAttachments': [
+                            {'ResourceType': 'vpc', 'ResourceId': 'vpc-1', 'TransitGatewayId': 'tgw-1',
+                             'Association': {'TransitGatewayRouteTableId': 'tgw-rtb-1'}}],
+                        'TransitGatewayRouteTables': [
+                            {'TransitGatewayRouteTableId': 'tgw-rtb-1',
+                             'Routes': [{'DestinationCidrBlock': '10.2.0.0/16',
+                                         'TransitGatewayAttachments': [{'ResourceId': 'vpc-2'}]}]}],
+                    }
+                }
+            }
+        }
+        self.reachability = reachability.RouteReachability.from_schema(schema)
+
+    def test_longest_prefix_match_across_route_tables(self):
+        result = self.reachability.lookup(['subnet-a', 'subnet-a', 'subnet-a', 'subnet-a', 'subnet-b', 'subnet-b'],
+                                          ['10.1.2.3', '10.2.0.1', '8.8.8.8', '10.9.1.1', '10.1.2.3', '8.8.8.8'])
+        self.assertEqual(list(self.reachability.labels(result['next_hop'])),
+                         ['local', 'tgw-1', 'nat-1', 'blackhole', 'local', None])
+        self.assertEqual(list(self.reachability.labels(result['route_table'], kind='route_table')),
+                         ['rtb-a', 'rtb-a', 'rtb-a', 'rtb-a', 'rtb-main', 'rtb-main'])
+        self.assertEqual(list(self.reachability.labels(result['tgw_next_hop'])),
+                         [None, 'vpc-2', None, None, None, None])
+
+
+class TestExportCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = checkpoint.ExportCheckpoint(os.path.join(self.directory, 'checkpoint'))
+        self.checkpoint.start('regions: []', {'customer': 'acme', 'regions': {}})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume_skips_completed_operations(self):
+        self.checkpoint.save('us-east-2', 'dev', 'ec2', 'describe_vpcs', {'Vpcs': [{'VpcId': 'vpc-1'}]})
+        self.checkpoint.start('regions: []', {'customer': 'acme'}, resume=True)
+        describe_vpcs = MagicMock(return_value={'Vpcs': [], 'ResponseMetadata': {}})
+        describe_subnets = MagicMock(return_value={'Subnets': [{'SubnetId': 'subnet-1'}], 'ResponseMetadata': {}})
+        describe_vpcs.__doc__ = describe_subnets.__doc__ = None
+        client = Mock(spec=['describe_subnets', 'describe_vpcs'])
+        client.describe_subnets = describe_subnets
+        client.describe_vpcs = describe_vpcs
+        with patch.object(aws_config_exporter.boto3, 'Session') as session:
+            session.return_value.client.return_value = client
+            aws_config_exporter.export_aws_config(
+                schema={}, keywords=['subnets', 'e_vpc'], excludes=[],
+                skip_methods=self.checkpoint.completed('us-east-2', 'dev', 'ec2'),
+                on_method_complete=partial(self.checkpoint.save, 'us-east-2', 'dev', 'ec2'))
+        describe_vpcs.assert_not_called()
+        describe_subnets.assert_called_once_with()
+        env = self.checkpoint.assemble({}, 'us-east-2', 'dev', 'ec2')
+        self.assertEqual(env, {'Subnets': [{'SubnetId': 'subnet-1'}], 'Vpcs': [{'VpcId': 'vpc-1'}]})
+
+    def test_resume_with_changed_definition_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.checkpoint.start('regions: [us-west-2]', {}, resume=True)
+        self.checkpoint.start('regions: [us-west-2]', {})
+        self.assertEqual(self.checkpoint.get_manifest()['header'], {})
+
+    def test_resume_after_completed_export_starts_fresh(self):
+        self.checkpoint.save('us-east-2', 'dev', 'ec2', 'describe_vpcs', {'Vpcs': [{'VpcId': 'vpc-1'}]})
+        self.checkpoint.complete()
+        self.checkpoint.start('regions: []', {}, resume=True)
+        self.assertEqual(self.checkpoint.completed('us-east-2', 'dev', 'ec2'), set())
+        self.assertNotIn('complete', self.checkpoint.get_manifest())
+
+    def test_resume_after_failed_export_keeps_units(self):
+        self.checkpoint.save('us-east-2', 'dev', 'ec2', 'describe_vpcs', {'Vpcs': [{'VpcId': 'vpc-1'}]})
+        self.checkpoint.start('regions: []', {}, resume=True)
+        self.assertEqual(self.checkpoint.completed('us-east-2', 'dev', 'ec2'), {'describe_vpcs'})
+
+    def test_clear_removes_only_checkpoint_files(self):
+        self.checkpoint.save('us-east-2', 'dev', 'ec2', 'describe_vpcs', {'Vpcs': [{'VpcId': 'vpc-1'}]})
+        unrelated = os.path.join(self.checkpoint.get_directory(), 'important.txt')
+        with open(unrelated, 'w') as f:
+            f.write('keep')
+        self.checkpoint.start('regions: []', {})
+        self.assertEqual(sorted(os.listdir(self.checkpoint.get_directory())), ['important.txt', 'manifest.json'])
+
+    def test_start_refuses_non_empty_directory_without_manifest(self):
+        with open(os.path.join(self.directory, 'important.txt'), 'w') as f:
+            f.write('keep')
+        with self.assertRaises(ValueError):
+            checkpoint.ExportCheckpoint(self.directory).start('regions: []', {})
+        self.assertEqual(sorted(os.listdir(self.directory)), ['checkpoint', 'important.txt'])
+
+
+class TestVisualizerExportLoading(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = {
+            'Vpcs': [{'VpcId': 'vpc-1', 'CidrBlock': '10.1.0.0/16', 'Tags': [{'Key': 'Name', 'Value': 'hub'}],
+                      'CidrBlockAssociationSet': [{'CidrBlock': '10.1.0.0/16'}]}],
+            'Subnets': [{'SubnetId': 'subnet-1', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-2a',
+                         'CidrBlock': '10.1.1.0/24', 'Tags': [{'Key': 'Name', 'Value': 'trust'}]}],
+            'RouteTables': [],
+            'Reservations': [],
+            'SecurityGroups': [{'GroupId': 'sg-1'}],
+        }
+        self.schema = {'cloud_provider': 'aws', 'customer': 'acme', 'regions': {'us-east-2': {'dev': self.env}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def map_export(self, path):
+        network = Visualizer()
+        network.load_export(path)
+        environments = list(network.iter_environments())
+        network.map_network_config()
+        return network, environments
+
+    @unittest.skipUnless(visualize.ijson, 'ijson is not installed')
+    def test_streamed_export_keeps_only_visual_fields(self):
+        path = os.path.join(self.directory, 'export.json')
+        aws_config_exporter.generate_json_file(path, self.schema)
+        network, environments = self.map_export(path)
+        self.assertEqual([(rk, ek) for rk, ek, _ in environments], [('us-east-2', 'dev')])
+        env = environments[0][2]
+        self.assertNotIn('SecurityGroups', env)
+        self.assertNotIn('CidrBlockAssociationSet', env['Vpcs'][0])
+        self.assertIsNone(network.get_config())
+        self.assertIn('trust', network._graph.nodes)
+
+    def test_json_fallback_keeps_only_visual_fields(self):
+        path = os.path.join(self.directory, 'export.json')
+        aws_config_exporter.generate_json_file(path, self.schema)
+        with patch.object(visualize, 'ijson', None):
+            network, environments = self.map_export(path)
+        env = environments[0][2]
+        self.assertNotIn('SecurityGroups', env)
+        self.assertNotIn('CidrBlockAssociationSet', env['Vpcs'][0])
+        self.assertIn('trust', network._graph.nodes)
+
+    def test_checkpoint_shards_are_read_per_environment(self):
+        store = checkpoint.ExportCheckpoint(os.path.join(self.directory, 'checkpoint'))
+        store.start('regions: []', self.schema)
+        store.save('us-east-2', 'dev', 'ec2', 'describe_vpcs', {'Vpcs': self.env['Vpcs']})
+        store.save('us-east-2', 'dev', 'ec2', 'describe_subnets', {'Subnets': self.env['Subnets']})
+        store.save('us-east-2', 'dev', 'ec2', 'describe_instances', {'Reservations': []})
+        store.save('us-east-2', 'dev', 'ec2', 'describe_route_tables', {'RouteTables': []})
+        network, environments = self.map_export(store.get_directory())
+        self.assertEqual(sorted(environments[0][2]), ['Reservations', 'RouteTables', 'Subnets', 'Vpcs'])
+        self.assertIn('hub', network._graph.nodes)
+
+
+class TestAwsConfigBackend(unittest.TestCase):
+
+    DESCRIBE_DOC = '''
+    **Request Syntax**
+    ::
+
+      response = client.describe(Filters=[{'Name': 'string', 'Values': ['string']}])
+    :type Filters: list
+    :param Filters: The filters.
+
+      * ``vpc-id`` - The ID of the VPC.
+    :param DryRun: Dry run.
+
+    **Response Syntax**
+    ::
+    '''
+
+    def setUp(self):
+        self.vpc_ids = ['vpc-1', 'vpc-2', 'vpc-3']
+        self.config = {
+            'aws_profile': None,
+            'backend': 'aws_config',
+            'aws_config': {'aggregator_name': 'org'},
+            'ec2_includes': ['e_vpc', 'subnets', 'e_instances', 'e_route_tables'],
+            'ec2_exclusions': ['vpc_attribute'],
+            'regions': [{'us-east-2': {'dev': {'vpc_ids': self.vpc_ids, 'tgw_ids': [], 'service_names': [],
+                                               'resource_types': ['ec2']}}}],
+        }
+        rows = [
+            {'resourceId': 'vpc-1', 'resourceType': 'AWS::EC2::VPC', 'awsRegion': 'us-east-2',
+             'configuration': {'vpcId': 'vpc-1', 'cidrBlock': '10.1.0.0/16'},
+             'tags': [{'key': 'Name', 'value': 'hub'}]},
+            {'resourceId': 'vpc-9', 'resourceType': 'AWS::EC2::VPC', 'awsRegion': 'us-east-2',
+             'configuration': {'vpcId': 'vpc-9', 'cidrBlock': '10.9.0.0/16'}, 'tags': []},
+            {'resourceId': 'subnet-1', 'resourceType': 'AWS::EC2::Subnet', 'awsRegion': 'us-east-2',
+             'configuration': {'subnetId': 'subnet-1', 'vpcId': 'vpc-1', 'availabilityZone': 'us-east-2a'}},
+            {'resourceId': 'i-1', 'resourceType': 'AWS::EC2::Instance', 'awsRegion': 'us-east-2',
+             'configuration': {'instanceId': 'i-1', 'vpcId': 'vpc-2', 'state': {'name': 'running'}}},
+            {'resourceId': 'rtb-1', 'resourceType': 'AWS::EC2::RouteTable', 'awsRegion': 'us-east-2',
+             'configuration': {'routeTableId': 'rtb-1', 'vpcId': 'vpc-1',
+                               'associations': [{'main': False, 'subnetId': 'subnet-1'}]}},
+        ]
+        self.config_client = self.select_client(rows[:3], rows[3:])
+
+    @staticmethod
+    def select_client(*pages):
+        results = [{'Results': [json.dumps(dict({'awsRegion': 'us-east-2'}, **r)) for r in rows]} for rows in pages]
+        for position, page in enumerate(results[:-1]):
+            page['NextToken'] = f'page-{position + 2}'
+        client = Mock(spec=['select_aggregate_resource_config'])
+        client.select_aggregate_resource_config = MagicMock(side_effect=results)
+        return client
+
+    @staticmethod
+    def example_config():
+        config = aws_config_exporter.load_definition(DEFINITIONS_EXAMPLE)
+        config['regions'] = config['regions'][:1]
+        config['regions'][0]['us-east-2']['dev']['vpc_ids'] = ['vpc-1']
+        return config
+
+    def test_query_results_normalized_to_describe_shape(self):
+        backend = config_backend.AwsConfigBackend('org', self.config_client)
+        schema = backend.export(self.config, aws_config_exporter.new_export_schema(self.config))
+        env = schema['regions']['us-east-2']['dev']
+        self.assertEqual(env['Vpcs'], [{'VpcId': 'vpc-1', 'CidrBlock': '10.1.0.0/16',
+                                        'Tags': [{'Key': 'Name', 'Value': 'hub'}]}])
+        self.assertEqual(env['Subnets'][0]['AvailabilityZone'], 'us-east-2a')
+        self.assertEqual(env['Reservations'][0]['Instances'][0]['State'], {'Name': 'running'})
+        self.assertEqual(env['RouteTables'][0]['Associations'][0]['AssociationState'], {'State': 'associated'})
+        expression = self.config_client.select_aggregate_resource_config.call_args_list[0][1]['Expression']
+        self.assertIn("'AWS::EC2::Instance', 'AWS::EC2::RouteTable', 'AWS::EC2::Subnet', 'AWS::EC2::VPC'", expression)
+
+    def test_call_count_against_describe_backend(self):
+        backend = config_backend.AwsConfigBackend('org', self.config_client)
+        backend.export(self.config, aws_config_exporter.new_export_schema(self.config))
+        config_calls = self.config_client.select_aggregate_resource_config.call_count
+
+        methods = ['describe_instances', 'describe_route_tables', 'describe_subnets', 'describe_vpcs']
+        ec2_client = Mock(spec=methods)
+        for method in methods:
+            describe = MagicMock(side_effect=lambda **kwargs: {'ResponseMetadata': {}})
+            describe.__doc__ = self.DESCRIBE_DOC
+            setattr(ec2_client, method, describe)
+        attrs = self.config['regions'][0]['us-east-2']['dev']
+        with patch.object(aws_config_exporter.boto3, 'Session') as session, \
+                patch.object(aws_config_exporter, 'tqdm', side_effect=lambda v, **kwargs: v):
+            session.return_value.client.return_value = ec2_client
+            aws_config_exporter.export_resource_type(self.config, 'us-east-2', attrs, 'ec2')
+        describe_calls = sum(getattr(ec2_client, method).call_count for method in methods)
+
+        self.assertEqual(config_calls, 2)
+        self.assertGreaterEqual(describe_calls, len(methods) * len(self.vpc_ids))
+        self.assertLess(config_calls, describe_calls)
+
+    def test_gateways_and_eips_are_placed_through_their_vpc_links(self):
+        client = self.select_client([
+            {'resourceId': 'eipalloc-1', 'resourceType': 'AWS::EC2::EIP',
+             'configuration': {'allocationId': 'eipalloc-1', 'networkInterfaceId': 'eni-1'}},
+            {'resourceId': 'igw-1', 'resourceType': 'AWS::EC2::InternetGateway',
+             'configuration': {'internetGatewayId': 'igw-1', 'attachments': [{'vpcId': 'vpc-1'}]}},
+            {'resourceId': 'vgw-1', 'resourceType': 'AWS::EC2::VPNGateway',
+             'configuration': {'vpnGatewayId': 'vgw-1', 'vpcAttachments': [{'vpcId': 'vpc-1'}]}},
+            {'resourceId': 'igw-2', 'resourceType': 'AWS::EC2::InternetGateway',
+             'configuration': {'internetGatewayId': 'igw-2', 'attachments': [{'vpcId': 'vpc-2'}]}},
+            {'resourceId': 'eni-1', 'resourceType': 'AWS::EC2::NetworkInterface',
+             'configuration': {'networkInterfaceId': 'eni-1', 'vpcId': 'vpc-1'}},
+        ])
+        config = self.example_config()
+        backend = config_backend.AwsConfigBackend('org', client)
+        env = backend.export(config, aws_config_exporter.new_export_schema(config))['regions']['us-east-2']['dev']
+        self.assertEqual([r['InternetGatewayId'] for r in env['InternetGateways']], ['igw-1'])
+        self.assertEqual([r['VpnGatewayId'] for r in env['VpnGateways']], ['vgw-1'])
+        self.assertEqual([r['AllocationId'] for r in env['Addresses']], ['eipalloc-1'])
+
+    def test_rows_are_placed_while_the_query_streams(self):
+        config = self.example_config()
+        schema = aws_config_exporter.new_export_schema(config)
+        placed = []
+
+        def select(expression):
+            yield {'resourceId': 'eipalloc-1', 'resourceType': 'AWS::EC2::EIP', 'awsRegion': 'us-east-2',
+                   'configuration': {'allocationId': 'eipalloc-1', 'networkInterfaceId': 'eni-1'}}
+            yield {'resourceId': 'vpc-1', 'resourceType': 'AWS::EC2::VPC', 'awsRegion': 'us-east-2',
+                   'configuration': {'vpcId': 'vpc-1'}}
+            env = schema['regions']['us-east-2']['dev']
+            placed.append((list(env['Vpcs']), list(env['Addresses'])))
+            yield {'resourceId': 'eni-1', 'resourceType': 'AWS::EC2::NetworkInterface', 'awsRegion': 'us-east-2',
+                   'configuration': {'networkInterfaceId': 'eni-1', 'vpcId': 'vpc-1'}}
+
+        backend = config_backend.AwsConfigBackend('org', self.select_client([]))
+        with patch.object(backend, 'select', side_effect=select):
+            backend.export(config, schema)
+        # The vpc is placed before the query ends, the elastic IP waits for the interface on a later row
+        self.assertEqual(placed, [([{'VpcId': 'vpc-1', 'Tags': []}], [])])
+        addresses = schema['regions']['us-east-2']['dev']['Addresses']
+        self.assertEqual([r['AllocationId'] for r in addresses], ['eipalloc-1'])
+
+    def test_example_includes_produce_describe_response_keys(self):
+        config = self.example_config()
+        attrs = config['regions'][0]['us-east-2']['dev']
+        # Describe backend against stubbed methods carrying the real boto3 docstrings and output shapes
+        real = boto3.client('ec2', region_name='us-east-2', aws_access_key_id='test', aws_secret_access_key='test')
+        methods = [m for m in dir(real) if m.startswith('describe_')]
+        ec2_client = Mock(spec=methods)
+        for method in methods:
+            operation = real.meta.service_model.operation_model(real.meta.method_to_api_mapping[method])
+            keys = [k for k, shape in (operation.output_shape.members if operation.output_shape else {}).items()
+                    if shape.type_name == 'list']
+            describe = MagicMock(side_effect=lambda keys=keys, **kwargs: dict({k: [] for k in keys},
+                                                                              ResponseMetadata={}))
+            describe.__doc__ = getattr(real, method).__doc__
+            setattr(ec2_client, method, describe)
+        with patch.object(aws_config_exporter.boto3, 'Session') as session, \
+                patch.object(aws_config_exporter, 'tqdm', side_effect=lambda v, **kwargs: v):
+            session.return_value.client.return_value = ec2_client
+            describe_keys = set(aws_config_exporter.export_resource_type(config, 'us-east-2', attrs, 'ec2'))
+
+        attrs['resource_types'] = ['ec2']
+        backend = config_backend.AwsConfigBackend('org', self.select_client([]))
+        with self.assertLogs('config_backend', level='WARNING') as logs:
+            schema = backend.export(config, aws_config_exporter.new_export_schema(config))
+        config_keys = set(schema['regions']['us-east-2']['dev'])
+
+        # describe_addresses has no vpc filter, only the aws_config backend places elastic IPs in environments
+        self.assertEqual(config_keys - describe_keys, {'Addresses'})
+        self.assertTrue({'Vpcs', 'Subnets', 'RouteTables', 'Reservations', 'NetworkInterfaces', 'InternetGateways',
+                         'VpnGateways', 'TransitGatewayAttachments'} <= config_keys & describe_keys)
+        for keyword in ('e_volumes', 'local_gateways', 'customer_gateways'):
+            self.assertTrue(any(f'Include {keyword} ' in line for line in logs.output), keyword)
+        self.assertFalse(any('Include e_vpc ' in line for line in logs.output))
+
+
+class TestStaticExport(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.network = self.map_network({
+            'Vpcs': [{'VpcId': 'vpc-1', 'CidrBlock': '10.1.0.0/16', 'Tags': [{'Key': 'Name', 'Value': 'hub'}]}],
+            'Subnets': [{'SubnetId': 'subnet-1', 'VpcId': 'vpc-1', 'AvailabilityZone': 'us-east-2a',
+                         'CidrBlock': '10.1.1.0/24', 'Tags': [{'Key': 'Name', 'Value': 'trust "a"'}]}],
+            'RouteTables': [], 'Reservations': []})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def map_network(env):
+        network = Visualizer()
+        network.set_header({'cloud_provider': 'aws', 'customer': 'acme'})
+        network.set_config({'regions': {'us-east-2': {'dev': env}}})
+        network.map_network_config()
+        return network
+
+    def read_dot(self, network):
+        with open(network.write_dot(os.path.join(self.directory, 'diagram.dot'))) as f:
+            return f.read()
+
+    def test_dot_file_clusters_regions_and_vpcs(self):
+        dot = self.read_dot(self.network)
+        self.assertIn('label="us-east-2";', dot)
+        self.assertIn('label="vpc-1";', dot)
+        self.assertIn('"trust \\"a\\"" [label="trust \\"a\\"" tooltip="cidr: 10.1.1.0/24 \\nid: subnet-1 \\n"];', dot)
+        self.assertIn('"hub" -> "trust \\"a\\"";', dot)
+        self.assertLess(dot.index('subgraph "cluster_0_1"'), dot.index('"hub" [label'))
+
+    def test_shared_nodes_are_promoted_to_the_region_cluster(self):
+        dot = self.read_dot(self.map_network({
+            'Vpcs': [{'VpcId': f'vpc-{v}', 'CidrBlock': f'10.{v}.0.0/16', 'Tags': []} for v in (1, 2)],
+            'Subnets': [{'SubnetId': f'subnet-{v}', 'VpcId': f'vpc-{v}', 'AvailabilityZone': 'us-east-2a',
+                         'CidrBlock': f'10.{v}.1.0/24', 'Tags': []} for v in (1, 2)],
+            'RouteTables': [],
+            'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'InstanceType': 't3.micro', 'ImageId': 'ami-1',
+                                             'KeyName': 'key', 'Placement': {'AvailabilityZone': 'us-east-2a'},
+                                             'State': {'Name': 'running'}, 'PrivateIpAddress': '10.1.1.10',
+                                             'Tags': []}]}]}))
+        region_nodes = dot[dot.index('label="us-east-2";'):dot.index('subgraph "cluster_0_1"')]
+        self.assertIn('"us-east-2a" [label', region_nodes)
+        self.assertIn('"i-1" [label', region_nodes)
+        vpc_cluster = dot[dot.index('subgraph "cluster_0_1"'):dot.index('subgraph "cluster_0_2"')]
+        self.assertIn('"subnet-1" [label', vpc_cluster)
+        self.assertNotIn('"us-east-2a" [label', vpc_cluster)
+
+    def test_render_static_is_headless(self):
+        filepath = os.path.join(self.directory, 'diagram')
+        with patch('visualize.graphviz.render', return_value=f'{filepath}.pdf') as render, \
+                self.assertLogs('visualize', level='INFO') as logs:
+            self.assertEqual(self.network.render_static(filepath, engine='neato', fmt='pdf'), f'{filepath}.pdf')
+        render.assert_called_once_with('neato', 'pdf', f'{filepath}.dot', outfile=f'{filepath}.pdf')
+        self.assertTrue(any('neato does not draw region and VPC clusters' in line for line in logs.output))
+        with self.assertRaises(ValueError):
+            self.network.render_static(filepath, engine='circo')
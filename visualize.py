@@ -2,14 +2,75 @@ import networkx as nx
 import json
 from pyvis.network import Network
 from pyvis.options import EdgeOptions
+import graphviz
 from graphviz import Digraph
 import re
+import os
+import tempfile
 import logging
+from checkpoint import ExportCheckpoint
+
+try:
+    import ijson
+except ImportError:  # Listed in requirements.txt, json.load with trimming is used without it
+    ijson = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+# Fields of each exported resource used for graph nodes and tooltips, everything else is dropped while loading
+VISUAL_FIELDS = {
+    'Vpcs': ('VpcId', 'CidrBlock', 'Tags'),
+    'Subnets': ('SubnetId', 'VpcId', 'AvailabilityZone', 'CidrBlock', 'Tags'),
+    'RouteTables': ('RouteTableId', 'Associations', 'Routes', 'Tags'),
+    'Reservations': ('Instances',),
+    'Instances': ('InstanceId', 'InstanceType', 'ImageId', 'KeyName', 'Placement', 'State', 'PrivateIpAddress', 'Tags'),
+}
+
+
+# Layout engines for static exports, sfdp and neato scale to graphs where dot does not finish
+STATIC_ENGINES = ('sfdp', 'neato', 'fdp', 'dot')
+# Only these engines draw the region and VPC clusters, sfdp and neato lay out the nodes but ignore the cluster boxes
+CLUSTER_ENGINES = ('fdp', 'dot')
+STATIC_FORMATS = ('svg', 'pdf', 'png')
+
+
+def dot_quote(value):
+    """
+    Quote a string as a DOT identifier
+    Args:
+        value: Node name, label or tooltip
+
+    Returns:
+
+    """
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{value}"'
+
+
+def trim_resource(resource_type, resource):
+    """
+    Keep only the fields of a resource needed for graph nodes and tooltips
+    Args:
+        resource_type: Response key of the describe method, e.g. Vpcs
+        resource: Resource dictionary
+
+    Returns:
+
+    """
+    trimmed = {k: resource[k] for k in VISUAL_FIELDS[resource_type] if k in resource}
+    if 'Tags' in trimmed:
+        trimmed['Tags'] = [tag for tag in trimmed['Tags'] if tag.get('Key') == 'Name']
+    if 'Routes' in trimmed:
+        trimmed['Routes'] = [{k: v for k, v in route.items() if k == 'DestinationCidrBlock' or 'Gateway' in k}
+                             for route in trimmed['Routes']]
+    if 'Associations' in trimmed:
+        trimmed['Associations'] = trimmed['Associations'][:1]
+    if 'Instances' in trimmed:
+        trimmed['Instances'] = [trim_resource('Instances', instance) for instance in trimmed['Instances']]
+    return trimmed
+
 
 class Visualizer:
     """
@@ -21,6 +82,7 @@ class Visualizer:
         self.vpc_name = None
         self.vpc_id = None
         self.environment_name = None
+        self.region_name = None
         self._icons = None
         self._graph = nx.Graph()
         self._config = None
@@ -30,6 +92,8 @@ class Visualizer:
         self._env_data = None
         self._provider = None
         self._customer = None
+        self._export_path = None
+        self._clusters = {}
         # self.base_ico_url = 'https://raw.githubusercontent.com/awslabs/aws-icons-for-plantuml/master/dist/'
 
     def get_base_ico_url(self):
@@ -59,6 +123,134 @@ class Visualizer:
     def get_config(self):
         return self._config
 
+    def set_header(self, header):
+        """
+        Set the provider and customer from the top level fields of an export
+        Args:
+            header: Dictionary with cloud_provider and customer
+
+        Returns:
+
+        """
+        self._provider = header.get('cloud_provider', 'aws')
+        self.set_icons()
+        self._customer = header.get('customer') or 'customer'
+
+    def load_export(self, path):
+        """
+        Read an export incrementally instead of holding it in memory. Environments are read one at a time while the
+        graph is mapped and only the fields needed for nodes and tooltips are kept, so peak memory tracks the graph
+        size rather than the export size
+        Args:
+            path: JSON export file, streamed with ijson when installed, or a checkpoint directory of export shards
+
+        Returns:
+
+        """
+        self._config = None
+        self._export_path = path
+        if os.path.isdir(path):
+            manifest = ExportCheckpoint(path).get_manifest()
+            if manifest is None:
+                raise ValueError(f'{path} is not an export checkpoint directory')
+            self.set_header(manifest.get('header', {}))
+        elif ijson is None:
+            logger.warning('ijson is not installed, the export is loaded in memory')
+            with open(path) as f:
+                config = json.load(f)
+            # Keep only the fields used for the graph, the full export is released environment by environment
+            for rv in config.get('regions', {}).values():
+                for ek, ev in rv.items():
+                    rv[ek] = {resource_type: [trim_resource(resource_type, r) for r in resources]
+                              for resource_type, resources in ev.items()
+                              if resource_type in VISUAL_FIELDS and isinstance(resources, list)}
+            self.set_config(config)
+
+    def iter_environments(self):
+        """
+        Iterate the environments of the loaded export
+
+        Returns:
+            Generator of (region, environment, environment data)
+
+        """
+        if self._config is not None:
+            for rk, rv in self._config['regions'].items():
+                for ek, ev in rv.items():
+                    yield rk, ek, ev
+        elif os.path.isdir(self._export_path):
+            yield from self._iter_shard_environments()
+        else:
+            yield from self._iter_streamed_environments()
+
+    def _iter_shard_environments(self):
+        """
+        Read the export shards of a checkpoint directory, one environment at a time
+
+        Returns:
+
+        """
+        checkpoint = ExportCheckpoint(self._export_path)
+        current = None
+        env_data = {}
+        for region, env, rtype, operation in checkpoint.iter_units():
+            if current is not None and current != (region, env):
+                yield current[0], current[1], env_data
+                env_data = {}
+            current = (region, env)
+            for resource_type, resources in checkpoint.load(region, env, rtype, operation).items():
+                if resource_type in VISUAL_FIELDS and isinstance(resources, list):
+                    env_data[resource_type] = [trim_resource(resource_type, r) for r in resources]
+        if current is not None:
+            yield current[0], current[1], env_data
+
+    def _iter_streamed_environments(self):
+        """
+        Stream a JSON export with ijson, building only the resources kept by VISUAL_FIELDS
+
+        Returns:
+
+        """
+        header = {}
+        region = env = resource_type = None
+        env_data = {}
+        builder = None
+        depth = 0
+        with open(self._export_path, 'rb') as f:
+            for prefix, event, value in ijson.parse(f):
+                if builder is not None:
+                    builder.event(event, value)
+                    if event in ('start_map', 'start_array'):
+                        depth += 1
+                    elif event in ('end_map', 'end_array'):
+                        depth -= 1
+                    if depth == 0:
+                        env_data[resource_type].append(trim_resource(resource_type, builder.value))
+                        builder = None
+                elif prefix in ('cloud_provider', 'customer') and event == 'string':
+                    header[prefix] = value
+                elif prefix == 'regions' and event == 'map_key':
+                    region = value
+                elif region is not None and prefix == f'regions.{region}':
+                    if event == 'map_key':
+                        env = value
+                        env_data = {}
+                        if self._provider is None:
+                            self.set_header(header)
+                elif env is not None and prefix == f'regions.{region}.{env}':
+                    if event == 'map_key':
+                        resource_type = value
+                        if resource_type in VISUAL_FIELDS:
+                            env_data[resource_type] = []
+                    elif event == 'end_map':
+                        yield region, env, env_data
+                        env_data = {}
+                elif event == 'start_map' and resource_type in VISUAL_FIELDS and \
+                        prefix == f'regions.{region}.{env}.{resource_type}.item':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+
     def set_html_file(self, filepath):
         """
         Set the pyvis html file path
@@ -92,7 +284,8 @@ class Visualizer:
         """
         self._env_data = data
 
-    def add_node_edge(self, node, edge_k, edge_v, title=None, shape='dot', image=None, size=None, group=None):
+    def add_node_edge(self, node, edge_k, edge_v, title=None, shape='dot', image=None, size=None, group=None,
+                      regional=False):
         """
         Add node and edges to the graph
         Args:
@@ -104,6 +297,7 @@ class Visualizer:
             image:
             size:
             group:
+            regional: Node is shared by the VPCs of a region (e.g. availability zones), never clustered in a VPC
 
         Returns:
 
@@ -113,6 +307,7 @@ class Visualizer:
                 self._graph.add_node(node, title=title, shape=shape, image=image, group=group)
             else:
                 self._graph.add_node(node, title=title, shape=shape, group=group)
+            self.assign_cluster(node, None if regional else self.vpc_id)
             if edge_k:
                 self._graph.add_edge(edge_k, edge_v)
             if size is not None:
@@ -120,6 +315,26 @@ class Visualizer:
         except Exception as e:
             logger.error(f'Error adding node: {node} to graph: {e}')
 
+    def assign_cluster(self, node, vpc):
+        """
+        Record the static export cluster of a node, nodes reached from several VPCs are promoted to their region
+        cluster and nodes reached from several regions to the top level
+        Args:
+            node:
+            vpc: VPC the node is reached from, None for the region cluster
+
+        Returns:
+
+        """
+        cluster = (self.region_name, vpc)
+        current = self._clusters.get(node)
+        if current is None or current == cluster:
+            self._clusters[node] = cluster
+        elif current[0] == self.region_name:
+            self._clusters[node] = (self.region_name, None)
+        else:
+            self._clusters[node] = (None, None)
+
     def lookup_if_tag_exists(self, tags, key, failback=None):
         """
         Lookup a tag in a list of tags
@@ -135,8 +350,7 @@ class Visualizer:
             for tag in tags:
                 if tag['Key'] == key:
                     return tag['Value']
-                else:
-                    return failback
+            return failback
         except Exception as e:
             logger.error(f'Error looking up tag: {e}')
 
@@ -219,7 +433,7 @@ class Visualizer:
                     self.add_node_edge(self.subnet_name, self.vpc_name, self.subnet_name, title=table, shape='image',
                                        image=self._icons["private_subnet_ico"], size=30, group=self.vpc_id)
                     self.add_node_edge(az, self.subnet_name, az, shape='image',
-                                       image=self._icons["zone_ico"], size=30)
+                                       image=self._icons["zone_ico"], size=30, regional=True)
                     self.process_instances()
                     self.process_route_tables()
             logger.info(f'Completed processing subnets for {self.vpc_name}:{self.vpc_id}')
@@ -351,13 +565,18 @@ class Visualizer:
     def map_network_config(self):
         logger.info('Mapping network configuration')
         try:
-            for rk, rv in self._config['regions'].items():
-                self.add_node_edge(rk, None, None, shape='image', image=self._icons["region_ico"], size=50)
-                for ek, ev in rv.items():
-                    self.set_env_data(ev)
-                    self.environment_name = ek
-                    self.add_node_edge(ek, rk, ek, shape='image', image=self._icons["env_ico"], size=40)
-                    self.process_virtual_networks()
+            regions = set()
+            for rk, ek, ev in self.iter_environments():
+                self.region_name = rk
+                self.vpc_id = None
+                if rk not in regions:
+                    self.add_node_edge(rk, None, None, shape='image', image=self._icons["region_ico"], size=50)
+                    regions.add(rk)
+                self.set_env_data(ev)
+                self.environment_name = ek
+                self.add_node_edge(ek, rk, ek, shape='image', image=self._icons["env_ico"], size=40)
+                self.process_virtual_networks()
+            self.set_env_data(None)
             logger.info('Completed mapping network data')
         except Exception as e:
             logger.error(f'Error mapping network data: {e}')
@@ -378,12 +597,15 @@ class Visualizer:
             for edge in net.edges:
                 edge['color'] = 'white'
             net.force_atlas_2based(overlap=1)
-            net.show(self._html_file)
             logging.warning('WORKAROUND: Removing secondary header from html file')
-            html_str = re.sub(r'<center>.+?<\/h1>\s+<\/center>', '', net.html, 1, re.DOTALL)
-            h = open(self._html_file, 'w')
-            h.write(html_str)
-            h.close()
+            html_str = re.sub(r'<center>.+?<\/h1>\s+<\/center>', '', net.generate_html(notebook=True), 1, re.DOTALL)
+            # Swap the html file in atomically so a watching browser never loads a partial diagram
+            directory = os.path.dirname(os.path.abspath(self._html_file))
+            fd, tmp_file = tempfile.mkstemp(prefix=f'.{os.path.basename(self._html_file)}.', dir=directory)
+            with os.fdopen(fd, 'w') as h:
+                h.write(html_str)
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, self._html_file)
         except Exception as e:
             logger.error(f'Error rendering web visuals: {e}')
             raise
@@ -407,18 +629,86 @@ class Visualizer:
             logger.error(f'Error rendering flowchart: {e}')
             raise
 
+    def write_dot(self, filepath):
+        """
+        Stream the graph to a DOT file, one line per node and edge, with a subgraph cluster per region and per VPC,
+        drawn as boxes by the CLUSTER_ENGINES
+        Args:
+            filepath: DOT filename
+
+        Returns:
 
-def main():
-    def load_json(filepath):
-        with open(filepath) as f:
-            data = json.load(f)
-        return data
+        """
+        logger.info(f'Writing DOT file {filepath}')
+        clusters = {}
+        for node in self._graph.nodes:
+            region, vpc = self._clusters.get(node, (None, None))
+            clusters.setdefault(region, {}).setdefault(vpc, []).append(node)
+
+        def write_nodes(f, nodes, indent):
+            for node in nodes:
+                title = self._graph.nodes[node].get('title')
+                tooltip = f' tooltip={dot_quote(title)}' if title else ''
+                f.write(f'{indent}{dot_quote(node)} [label={dot_quote(node)}{tooltip}];\n')
+
+        with open(filepath, 'w') as f:
+            f.write(f'digraph {dot_quote(self._customer or "aws")} {{\n')
+            f.write('  graph [overlap=prism, splines=false, outputorder=edgesfirst];\n')
+            f.write('  node [shape=box, style=filled, fillcolor=orange];\n')
+            for cluster_number, (region, vpcs) in enumerate(clusters.items()):
+                if region is None:
+                    write_nodes(f, [n for nodes in vpcs.values() for n in nodes], '  ')
+                    continue
+                f.write(f'  subgraph {dot_quote(f"cluster_{cluster_number}")} {{\n')
+                f.write(f'    label={dot_quote(region)};\n')
+                for vpc_number, (vpc, nodes) in enumerate(vpcs.items()):
+                    if vpc is None:
+                        write_nodes(f, nodes, '    ')
+                        continue
+                    f.write(f'    subgraph {dot_quote(f"cluster_{cluster_number}_{vpc_number}")} {{\n')
+                    f.write(f'      label={dot_quote(vpc)};\n')
+                    write_nodes(f, nodes, '      ')
+                    f.write('    }\n')
+                f.write('  }\n')
+            for edge_k, edge_v in self._graph.edges:
+                f.write(f'  {dot_quote(edge_k)} -> {dot_quote(edge_v)};\n')
+            f.write('}\n')
+        return filepath
+
+    def render_static(self, filepath, engine='sfdp', fmt='svg'):
+        """
+        Render a static diagram without a viewer, suitable for headless servers and large graphs. Region and VPC
+        cluster boxes are only drawn by the fdp and dot engines, the default sfdp trades them for scale
+        Args:
+            filepath: Output filename without extension, the DOT file is kept next to it
+            engine: Graphviz layout engine, one of STATIC_ENGINES
+            fmt: Output format, one of STATIC_FORMATS
+
+        Returns:
+            Path of the rendered diagram
+
+        """
+        if engine not in STATIC_ENGINES:
+            raise ValueError(f'Unsupported layout engine {engine}, expected one of {STATIC_ENGINES}')
+        if fmt not in STATIC_FORMATS:
+            raise ValueError(f'Unsupported output format {fmt}, expected one of {STATIC_FORMATS}')
+        logger.info(f'Rendering static {fmt} diagram with {engine}')
+        if engine not in CLUSTER_ENGINES:
+            logger.info(f'{engine} does not draw region and VPC clusters, use fdp or dot for clustered output')
+        try:
+            dot_file = self.write_dot(f'{filepath}.dot')
+            return graphviz.render(engine, fmt, dot_file, outfile=f'{filepath}.{fmt}')
+        except Exception as e:
+            logger.error(f'Error rendering static diagram: {e}')
+            raise
 
+
+def main():
     network = Visualizer()
     network.set_base_ico_url('https://raw.githubusercontent.com/ancoleman/graph-icons/main/')
     network.set_html_file('aws_network_diagram.html')
     network.set_flowchart_file('aws_network_diagram.png')
-    network.set_config(load_json('multi-region-aws-config_old.json'))
+    network.load_export('multi-region-aws-config_old.json')
     network.map_network_config()
     network.render_web_visual()
 
@@ -0,0 +1,135 @@
+import heapq
+import itertools
+import time
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """
+    Schedule recurring refreshes of export units, each on its own interval. Units are started with a stagger
+    between them, the longest overdue unit is refreshed first so no unit starves and consecutive refreshes are never
+    closer together than the stagger, which keeps the API load smooth. Outputs are published at most once per
+    publish interval, or when the loop goes idle, so the cost of a publish never paces the refreshes.
+    """
+    def __init__(self, stagger=5, publish_interval=60, clock=time.monotonic, sleep=time.sleep):
+        self._stagger = stagger
+        self._publish_interval = publish_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._units = []
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._units)
+
+    def add(self, unit, interval):
+        """
+        Add a unit to refresh
+        Args:
+            unit: Hashable unit identifier, e.g. (region, env, resource type, keyword)
+            interval: Seconds between refreshes of the unit
+
+        Returns:
+
+        """
+        if interval <= 0:
+            raise ValueError(f'Refresh interval for {unit} must be positive, got {interval}')
+        self._units.append((interval, unit))
+
+    def _schedule(self, seeded=False):
+        """
+        Stagger the first refresh of every unit, most frequently refreshed units first
+        Args:
+            seeded: Units were just exported, their first refresh waits for their interval
+
+        Returns:
+
+        """
+        now = self._clock()
+        self._queue = []
+        for position, (interval, unit) in enumerate(sorted(self._units, key=lambda u: u[0])):
+            due = now + position * self._stagger + (interval if seeded else 0)
+            heapq.heappush(self._queue, (due, interval, next(self._sequence), unit))
+
+    def _next_due(self):
+        """
+        Pop the next unit to refresh. Overdue units run in due time order, the shortest interval only breaks ties,
+        so a saturated schedule delays every unit instead of starving the long intervals
+
+        Returns:
+
+        """
+        return heapq.heappop(self._queue)
+
+    def _check_load(self):
+        """
+        Warn when the units ask for more refreshes than the stagger allows, every refresh then runs late
+        """
+        load = sum(1 / interval for interval, _ in self._units)
+        if load * self._stagger > 1:
+            logger.warning(f'{len(self._units)} units need {load * 3600:.0f} refreshes per hour but the stagger of '
+                           f'{self._stagger} seconds allows {3600 / self._stagger:.0f}, refreshes will run late')
+
+    def _publish(self, publish, units):
+        """
+        Publish the outputs of the refreshed units, a failed publish is retried with the next batch
+        """
+        try:
+            publish(units)
+        except Exception as e:
+            logger.error(f'Refreshed {len(units)} units but failed to publish the outputs: {e}')
+
+    def run(self, refresh, publish, max_refreshes=None, seeded=False):
+        """
+        Run the refresh loop
+        Args:
+            refresh: Callable receiving the unit to refresh
+            publish: Callable receiving the list of units refreshed since the last publish, writes the outputs
+            max_refreshes: Stop after this many refreshes, runs forever when None
+            seeded: Every unit was exported before the loop starts, delay first refreshes by their interval
+
+        Returns:
+
+        """
+        self._check_load()
+        self._schedule(seeded=seeded)
+        last_started = None
+        last_published = None
+        pending = []
+        completed = 0
+        while self._queue and (max_refreshes is None or completed < max_refreshes):
+            due, interval, _, unit = self._next_due()
+            start = due if last_started is None else max(due, last_started + self._stagger)
+            now = self._clock()
+            if pending and start > now:
+                # The loop is idle until the next refresh, publish once the publish interval allows it
+                deadline = now if last_published is None else max(now, last_published + self._publish_interval)
+                if deadline < start:
+                    if deadline > now:
+                        self._sleep(deadline - now)
+                    last_published = self._clock()
+                    self._publish(publish, pending)
+                    pending = []
+                    now = self._clock()
+            if start > now:
+                self._sleep(start - now)
+            last_started = self._clock()
+            try:
+                refresh(unit)
+            except Exception as e:
+                logger.error(f'Failed to refresh {unit}, retrying in {interval} seconds: {e}')
+            else:
+                pending.append(unit)
+                if last_published is None or self._clock() - last_published >= self._publish_interval:
+                    last_published = self._clock()
+                    self._publish(publish, pending)
+                    pending = []
+            completed += 1
+            heapq.heappush(self._queue, (last_started + interval, interval, next(self._sequence), unit))
+        if pending:
+            self._publish(publish, pending)